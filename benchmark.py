@@ -0,0 +1,381 @@
+"""
+📈 Бенчмарк масштабирования Прогресс Бота по размеру базы знаний.
+- Генерирует синтетические русские базы (по умолчанию от 100 до 100 000 записей) из словаря main.json.
+- Каждый размер меряется в отдельном процессе: время preprocess_knowledge_base по этапам,
+  задержка search_knowledge_base по этапам и пиковый RSS не смешиваются между размерами.
+- Отчёт: таблицы по размерам и показатель роста каждой метрики — где сложность ломается.
+
+Запуск: python benchmark.py --sizes 100,1000,10000,100000 --queries 100
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import main
+
+DEFAULT_SIZES = "100,300,1000,3000,10000,30000,100000"
+JUNK_QUERIES = ["ыва ыва", "qwerty", "а что там с погодой", "купи слона", "123"]
+
+# Этапы каскада в том порядке, в котором их проходит search_knowledge_base.
+# Итог — full_search, а не total: точные совпадения отвечаются из таблицы за микросекунды,
+# и их доля в выборке исказила бы и перцентили, и показатель роста полного поиска.
+SEARCH_STAGES = ["exact", "analyze", "phrase_bonus", "candidates", "keyword", "fulltext", "full_search"]
+BUILD_STAGES = ["keywords", "tfidf", "exact_index", "total"]
+
+# Рост метрики как n^k: k выше этого порога между соседними размерами — сверхлинейный участок
+SUPERLINEAR_EXPONENT = 1.2
+
+# ============================================================
+# 🧬 СИНТЕТИЧЕСКАЯ БАЗА ЗНАНИЙ
+# ============================================================
+
+class SyntheticKB:
+    """
+    Генератор записей по образцу main.json: тексты — цепь Маркова по биграммам настоящих ответов,
+    ключевые фразы — из настоящих ключей и слов сгенерированного ответа (чтобы поиск находил запись).
+    """
+
+    def __init__(self, kb_path: str, seed: int):
+        self.random = random.Random(seed)
+        self.transitions: Dict[str, List[str]] = defaultdict(list)
+        self.starts: List[str] = []
+        self.context_lengths: List[int] = []
+        self.keyword_counts: List[int] = []
+        self.keyword_phrases: List[str] = []
+
+        for entry in main.iter_knowledge_base(kb_path):
+            words = main.preprocess_text(entry["context"]).split()
+            if len(words) < 2:
+                continue
+            self.starts.append(words[0])
+            self.context_lengths.append(len(words))
+            for current, following in zip(words, words[1:]):
+                self.transitions[current].append(following)
+            self.keyword_counts.append(len(entry["keywords"]))
+            self.keyword_phrases.extend(entry["keywords"])
+        self.vocabulary = sorted(self.transitions)
+
+    def context(self) -> str:
+        word = self.random.choice(self.starts)
+        words = [word]
+        for _ in range(self.random.choice(self.context_lengths) - 1):
+            followers = self.transitions.get(word)
+            word = self.random.choice(followers) if followers else self.random.choice(self.vocabulary)
+            words.append(word)
+        return " ".join(words)
+
+    def keywords(self, context: str) -> List[str]:
+        words = [word for word in context.split() if len(word) > 3]
+        keywords = []
+        for _ in range(max(1, self.random.choice(self.keyword_counts))):
+            if words and self.random.random() < 0.5:
+                start = self.random.randrange(len(words))
+                keywords.append(" ".join(words[start:start + self.random.randint(1, 3)]))
+            else:
+                keywords.append(self.random.choice(self.keyword_phrases))
+        return keywords
+
+    def write(self, file_path: str, size: int) -> List[dict]:
+        """Пишет базу в JSONL построчно (без списка в памяти) и возвращает образцы записей для запросов."""
+        samples = []
+        with open(file_path, "w", encoding="utf-8") as f:
+            for i in range(size):
+                context = self.context()
+                entry = {"context": context, "keywords": self.keywords(context)}
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                # Резервуарная выборка: равномерные образцы по всей базе
+                if len(samples) < 200:
+                    samples.append(entry)
+                elif self.random.random() < 200 / (i + 1):
+                    samples[self.random.randrange(200)] = entry
+        return samples
+
+    def queries(self, samples: List[dict], count: int) -> List[str]:
+        queries = []
+        for _ in range(count):
+            roll = self.random.random()
+            entry = self.random.choice(samples)
+            if roll < 0.3:
+                queries.append(self.random.choice(entry["keywords"]))
+            elif roll < 0.9:
+                words = entry["context"].split()
+                start = self.random.randrange(max(1, len(words) - 6))
+                queries.append(" ".join(words[start:start + self.random.randint(2, 6)]))
+            else:
+                queries.append(self.random.choice(JUNK_QUERIES))
+        return queries
+
+# ============================================================
+# ⏱ ЗАМЕР ОДНОГО РАЗМЕРА (В ОТДЕЛЬНОМ ПРОЦЕССЕ)
+# ============================================================
+
+def peak_rss_mb() -> float:
+    # ru_maxrss: на Linux в КиБ, на macOS в байтах
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+
+
+def timed_build(kb_path: str) -> Tuple[main.KBIndex, Dict[str, float]]:
+    """preprocess_knowledge_base с разбивкой по этапам: TF-IDF и таблица точных фраз засекаются изнутри."""
+    timings: Dict[str, float] = defaultdict(float)
+    build_tfidf_index = main.KBIndex.build_tfidf_index
+    build_exact_match_index = main.build_exact_match_index
+
+    def timed(stage, func):
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timings[stage] += time.perf_counter() - started
+        return wrapper
+
+    main.KBIndex.build_tfidf_index = timed("tfidf", build_tfidf_index)
+    main.build_exact_match_index = timed("exact_index", build_exact_match_index)
+    try:
+        started = time.perf_counter()
+        kb_index = main.preprocess_knowledge_base(main.iter_knowledge_base(kb_path))
+        timings["total"] = time.perf_counter() - started
+    finally:
+        main.KBIndex.build_tfidf_index = build_tfidf_index
+        main.build_exact_match_index = build_exact_match_index
+    timings["keywords"] = timings["total"] - timings["tfidf"] - timings["exact_index"]
+    return kb_index, dict(timings)
+
+
+def timed_search(kb_index: main.KBIndex, query: str) -> Dict[str, float]:
+    """Этапы search_knowledge_base по отдельности, затем весь поиск целиком (без контекста диалога)."""
+    timings = {}
+    started = time.perf_counter()
+    canned = kb_index.exact_match(query)
+    timings["exact"] = time.perf_counter() - started
+
+    if canned is None:
+        started = time.perf_counter()
+        analysis = main.analyze_query(main.preprocess_question(query), kb_index)
+        timings["analyze"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        analysis.phrase_bonus(kb_index)
+        timings["phrase_bonus"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        candidates = kb_index.cascade_candidates(analysis)
+        timings["candidates"] = time.perf_counter() - started
+
+        # Бонус уже посчитан и закэширован — здесь только оценка кандидатов и сортировка
+        started = time.perf_counter()
+        kb_index.keyword_search(analysis, top_k=5, candidates=candidates)
+        timings["keyword"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        kb_index.fulltext_search(analysis, top_k=5, candidates=candidates)
+        timings["fulltext"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    main.search_knowledge_base(query, kb_index)
+    timings["total"] = time.perf_counter() - started
+    return timings
+
+
+def run_size(kb_path: str, queries_path: str, query_budget: float) -> dict:
+    result = {"rss_import_mb": peak_rss_mb()}
+    kb_index, result["build"] = timed_build(kb_path)
+    result["rss_build_mb"] = peak_rss_mb()
+    result["items"] = len(kb_index.items)
+    result["lemmas"] = len(kb_index.lemma_terms)
+
+    with open(queries_path, encoding="utf-8") as f:
+        queries = json.load(f)
+    stages: Dict[str, List[float]] = defaultdict(list)
+    deadline = time.perf_counter() + query_budget
+    for i, query in enumerate(queries):
+        # На больших базах запрос может идти секундами: бюджет ограничивает замер, но не меньше 5 запросов
+        if i >= 5 and time.perf_counter() > deadline:
+            break
+        timings = timed_search(kb_index, query)
+        for stage, seconds in timings.items():
+            stages[stage].append(seconds)
+        if "analyze" in timings:
+            # Время запросов, прошедших все этапы, — знаменатель долей этапов в отчёте
+            stages["full_search"].append(timings["total"])
+    result["queries"] = len(stages["total"])
+    result["search"] = {stage: values for stage, values in stages.items()}
+    result["rss_search_mb"] = peak_rss_mb()
+    return result
+
+# ============================================================
+# 📊 ОТЧЁТ
+# ============================================================
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def growth_exponent(sizes: List[int], values: List[float]) -> List[Optional[float]]:
+    """Показатель k в values ~ size^k между соседними размерами."""
+    exponents = []
+    for (n1, v1), (n2, v2) in zip(zip(sizes, values), zip(sizes[1:], values[1:])):
+        if v1 <= 0 or v2 <= 0 or n1 == n2:
+            exponents.append(None)
+        else:
+            exponents.append(math.log(v2 / v1) / math.log(n2 / n1))
+    return exponents
+
+
+def print_report(results: Dict[int, dict]) -> None:
+    sizes = sorted(size for size, result in results.items() if "error" not in result)
+
+    print("\n🏗 Построение индекса, с")
+    print(f"{'записей':>8} {'леммы':>7} " + " ".join(f"{stage:>11}" for stage in BUILD_STAGES))
+    for size in sizes:
+        build = results[size]["build"]
+        print(f"{size:>8} {results[size]['lemmas']:>7} " + " ".join(f"{build[stage]:>11.3f}" for stage in BUILD_STAGES))
+
+    print("\n🔎 Поиск, p50 / p95 мс")
+    print(f"{'записей':>8} {'запросов':>9} " + " ".join(f"{stage:>17}" for stage in SEARCH_STAGES))
+    for size in sizes:
+        search = results[size]["search"]
+        cells = []
+        for stage in SEARCH_STAGES:
+            values = search.get(stage, [])
+            cells.append(f"{percentile(values, 50) * 1000:>8.2f}/{percentile(values, 95) * 1000:<8.2f}")
+        print(f"{size:>8} {results[size]['queries']:>9} " + " ".join(cells))
+
+    print("\n🧠 Пиковый RSS, МБ")
+    print(f"{'записей':>8} {'импорт':>8} {'индекс':>8} {'поиск':>8} {'индекс−импорт':>14}")
+    for size in sizes:
+        r = results[size]
+        print(
+            f"{size:>8} {r['rss_import_mb']:>8.1f} {r['rss_build_mb']:>8.1f} {r['rss_search_mb']:>8.1f} "
+            f"{r['rss_build_mb'] - r['rss_import_mb']:>14.1f}"
+        )
+
+    failed = {size: result["error"] for size, result in results.items() if "error" in result}
+    for size, error in sorted(failed.items()):
+        print(f"\n❌ {size} записей: {error}")
+
+    if len(sizes) < 2:
+        return
+
+    metrics = {f"построение: {stage}": [results[size]["build"][stage] for size in sizes] for stage in BUILD_STAGES}
+    for stage in SEARCH_STAGES:
+        metrics[f"поиск p50: {stage}"] = [percentile(results[size]["search"].get(stage, []), 50) for size in sizes]
+    metrics["память индекса"] = [results[size]["rss_build_mb"] - results[size]["rss_import_mb"] for size in sizes]
+
+    print(f"\n📐 Показатель роста k (метрика ~ n^k) между соседними размерами; > {SUPERLINEAR_EXPONENT} — сверхлинейно")
+    print(f"{'метрика':<26} " + " ".join(f"{f'{a}→{b}':>13}" for a, b in zip(sizes, sizes[1:])))
+    breakdowns = []
+    for name, values in metrics.items():
+        exponents = growth_exponent(sizes, values)
+        print(f"{name:<26} " + " ".join(f"{k:>13.2f}" if k is not None else f"{'—':>13}" for k in exponents))
+        for (a, b), k in zip(zip(sizes, sizes[1:]), exponents):
+            if k is not None and k > SUPERLINEAR_EXPONENT:
+                breakdowns.append((name, a, b, k))
+                break
+
+    largest = sizes[-1]
+    search = results[largest]["search"]
+    full_search = sum(search.get("full_search", []))
+    stage_shares = {
+        stage: sum(search[stage]) / full_search
+        for stage in SEARCH_STAGES[1:-1] if full_search and search.get(stage)
+    }
+    build = results[largest]["build"]
+
+    print(f"\n🚨 Где ломается масштабирование")
+    if breakdowns:
+        for name, a, b, k in breakdowns:
+            print(f"  • {name}: рост n^{k:.2f} начиная с {a}→{b} записей")
+    else:
+        print(f"  Все метрики растут не быстрее n^{SUPERLINEAR_EXPONENT}")
+    if stage_shares:
+        heaviest = max(stage_shares, key=stage_shares.get)
+        print(f"  • На {largest} записях дольше всего в поиске этап {heaviest}: {stage_shares[heaviest]:.0%} времени полного поиска")
+    heaviest_build = max(BUILD_STAGES[:-1], key=lambda stage: build[stage])
+    print(f"  • В построении на {largest} записях — этап {heaviest_build}: {build[heaviest_build] / build['total']:.0%} времени")
+
+# ============================================================
+# 🚀 ЗАПУСК
+# ============================================================
+
+def measure_in_subprocess(kb_path: str, queries_path: str, args: argparse.Namespace) -> dict:
+    command = [
+        sys.executable, os.path.abspath(__file__), "--measure", kb_path,
+        "--queries-file", queries_path, "--query-budget", str(args.query_budget),
+    ]
+    try:
+        completed = subprocess.run(command, capture_output=True, text=True, timeout=args.timeout)
+    except subprocess.TimeoutExpired:
+        return {"error": f"не уложился в {args.timeout:.0f} с"}
+    if completed.returncode != 0:
+        return {"error": completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else f"код {completed.returncode}"}
+    # Результат — последняя строка stdout; всё остальное — логи бота
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def run_benchmark(args: argparse.Namespace) -> None:
+    sizes = sorted({int(size) for size in args.sizes.split(",") if size.strip()})
+    generator = SyntheticKB(os.path.abspath(args.kb), args.seed)
+    workdir = tempfile.mkdtemp(prefix="progress_benchmark_")
+    print(f"Словарь: {len(generator.vocabulary)} слов из {args.kb}; синтетические базы в {workdir}")
+
+    results: Dict[int, dict] = {}
+    for size in sizes:
+        kb_path = os.path.join(workdir, f"kb_{size}.jsonl")
+        queries_path = os.path.join(workdir, f"queries_{size}.json")
+        samples = generator.write(kb_path, size)
+        with open(queries_path, "w", encoding="utf-8") as f:
+            json.dump(generator.queries(samples, args.queries), f, ensure_ascii=False)
+
+        started = time.perf_counter()
+        results[size] = measure_in_subprocess(kb_path, queries_path, args)
+        status = results[size].get("error", "ok")
+        print(f"  {size:>7} записей: {time.perf_counter() - started:.1f} с, {status}")
+        if not args.keep_files:
+            os.remove(kb_path)
+
+    print_report(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\nСырые результаты: {args.json}")
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарк масштабирования Прогресс Бота по размеру базы знаний")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="размеры баз через запятую")
+    parser.add_argument("--queries", type=int, default=100, help="запросов на размер")
+    parser.add_argument("--query-budget", type=float, default=60.0, help="сколько секунд максимум тратить на запросы одного размера")
+    parser.add_argument("--timeout", type=float, default=1800.0, help="предел на один размер, с")
+    parser.add_argument("--kb", default="main.json", help="база, из словаря которой строятся синтетические")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", help="сохранить сырые результаты в файл")
+    parser.add_argument("--keep-files", action="store_true", help="не удалять сгенерированные базы")
+    # Внутренний режим: замер одного размера в отдельном процессе
+    parser.add_argument("--measure", help=argparse.SUPPRESS)
+    parser.add_argument("--queries-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        result = run_size(args.measure, args.queries_file, args.query_budget)
+        print(json.dumps(result))
+        return
+    run_benchmark(args)
+
+
+if __name__ == "__main__":
+    main_cli()
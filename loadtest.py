@@ -0,0 +1,410 @@
+"""
+🏋️ Нагрузочный тест Прогресс Бота без настоящего Telegram.
+- Поднимает локальный фейковый Bot API и направляет на него Application.
+- N пользователей параллельно шлют сообщения, нажимают кнопки меню и оценивают ответы.
+- Отчёт: пропускная способность, перцентили задержки, лаг event loop и RSS во времени.
+
+Запуск: python loadtest.py --users 50 --duration 60 --mix message=0.6,menu=0.3,feedback=0.1
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+from telegram import Update
+
+import main
+
+FAKE_TOKEN = "123456:LOADTEST"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "LoadBot", "username": "load_bot"}
+FIRST_USER_ID = 1_000_000
+
+# Ответ бота пользователю: после такого запроса действие пользователя считается обслуженным
+RESPONSE_METHODS = {"sendmessage", "editmessagetext", "editmessagereplymarkup"}
+MENU_CALLBACKS = ["menu_cost", "menu_method", "menu_about", "menu_main", "menu_consult", "menu_roadmaps"]
+JUNK_MESSAGES = ["ыва ыва", "qwerty", "а что там с погодой", "купи слона", "123"]
+
+# ============================================================
+# 🧪 ФЕЙКОВЫЙ BOT API
+# ============================================================
+
+class FakeBotAPI:
+    """
+    Минимальный HTTP/1.1 сервер с keep-alive, отвечающий как Bot API.
+    Работает в своём потоке и event loop, чтобы не искажать лаг event loop бота.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.port: Optional[int] = None
+        self.calls: Counter = Counter()
+        self.message_id = 0
+        self.waiters: Dict[int, Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = {}
+        self.lock = threading.Lock()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.server = None
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+        self.ready.wait()
+
+    def stop(self) -> None:
+        if self.loop is not None:
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result(timeout=5)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=5)
+        if self.loop is not None:
+            self.loop.close()
+
+    async def _shutdown(self) -> None:
+        self.server.close()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _run(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(asyncio.start_server(self._handle, "127.0.0.1", 0))
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.ready.set()
+        self.loop.run_forever()
+
+    def expect_response(self, chat_id: int) -> asyncio.Future:
+        """Future завершится, когда бот ответит в чат chat_id."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.lock:
+            self.waiters[chat_id] = (loop, future)
+        return future
+
+    def _resolve(self, chat_id: int) -> None:
+        with self.lock:
+            waiter = self.waiters.pop(chat_id, None)
+        if waiter is not None:
+            loop, future = waiter
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(time.perf_counter()))
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                lines = head.decode("latin-1").split("\r\n")
+                path = lines[0].split(" ")[1]
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        key, value = line.split(":", 1)
+                        headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", "0")))
+                result = await self._dispatch(path.rsplit("/", 1)[-1].lower(), self._parse_params(headers, body))
+                payload = json.dumps({"ok": True, "result": result}).encode("utf-8")
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(payload)}\r\n\r\n".encode("latin-1")
+                    + payload
+                )
+                await writer.drain()
+        except asyncio.CancelledError:
+            # Отменённую задачу соединения asyncio (3.11) логирует как ошибку — завершаемся штатно
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _parse_params(headers: Dict[str, str], body: bytes) -> Dict[str, str]:
+        if not body:
+            return {}
+        if headers.get("content-type", "").startswith("application/json"):
+            return json.loads(body)
+        return {key: values[0] for key, values in parse_qs(body.decode("utf-8")).items()}
+
+    async def _dispatch(self, method: str, params: Dict[str, str]):
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method == "getme":
+            return BOT_USER
+        if method in RESPONSE_METHODS:
+            chat_id = int(params.get("chat_id", 0))
+            self._resolve(chat_id)
+            self.message_id += 1
+            return {
+                "message_id": int(params.get("message_id", self.message_id)),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+        if method == "getupdates":
+            return []
+        return True
+
+# ============================================================
+# 👥 ВИРТУАЛЬНЫЕ ПОЛЬЗОВАТЕЛИ
+# ============================================================
+
+class UpdateFactory:
+    def __init__(self, kb_index: main.KBIndex, seed: int):
+        self.random = random.Random(seed)
+        self.update_id = 0
+        self.kb_size = len(kb_index.items)
+        self.keywords = sorted(kb_index.all_keywords_list)
+        self.words = [word for item in kb_index.items for word in main.preprocess_text(item.context).split() if len(word) > 3]
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+    def _next_id(self) -> int:
+        self.update_id += 1
+        return self.update_id
+
+    def message_text(self) -> str:
+        roll = self.random.random()
+        if roll < 0.4:
+            return self.random.choice(self.keywords)
+        if roll < 0.9:
+            return " ".join(self.random.sample(self.words, self.random.randint(2, 6)))
+        return self.random.choice(JUNK_MESSAGES)
+
+    def message(self, user_id: int) -> dict:
+        return {
+            "update_id": self._next_id(),
+            "message": {
+                "message_id": self._next_id(),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": self._user(user_id),
+                "text": self.message_text(),
+            },
+        }
+
+    def callback(self, user_id: int, data: str) -> dict:
+        return {
+            "update_id": self._next_id(),
+            "callback_query": {
+                "id": str(self._next_id()),
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": {
+                    "message_id": self._next_id(),
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "from": BOT_USER,
+                    "text": "…",
+                },
+            },
+        }
+
+    def menu(self, user_id: int) -> dict:
+        return self.callback(user_id, self.random.choice(MENU_CALLBACKS))
+
+    def feedback(self, user_id: int) -> dict:
+        kind = "like" if self.random.random() < 0.7 else "dislike"
+        return self.callback(user_id, f"{kind}_{self.random.randrange(self.kb_size)}")
+
+
+class LoadStats:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.timeouts: Counter = Counter()
+        self.loop_lags: List[float] = []
+        self.rss_samples: List[Tuple[float, int, int]] = []  # (t, RSS байт, обслужено действий)
+
+    @property
+    def completed(self) -> int:
+        return sum(len(values) for values in self.latencies.values())
+
+
+def current_rss() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # Не Linux: доступен только пиковый RSS (на macOS в байтах, на Linux в КиБ)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+async def simulate_user(application, api: FakeBotAPI, factory: UpdateFactory, stats: LoadStats,
+                        user_id: int, mix: List[Tuple[str, float]], deadline: float,
+                        think_time: float, timeout: float) -> None:
+    kinds = [kind for kind, _ in mix]
+    weights = [weight for _, weight in mix]
+    while time.perf_counter() < deadline:
+        kind = factory.random.choices(kinds, weights)[0]
+        update = Update.de_json(getattr(factory, kind)(user_id), application.bot)
+        response = api.expect_response(user_id)
+        started = time.perf_counter()
+        await application.update_queue.put(update)
+        try:
+            finished = await asyncio.wait_for(response, timeout)
+            stats.latencies[kind].append(finished - started)
+        except asyncio.TimeoutError:
+            stats.timeouts[kind] += 1
+        if think_time:
+            await asyncio.sleep(factory.random.expovariate(1 / think_time))
+
+
+async def monitor_loop_lag(stats: LoadStats, stop: asyncio.Event, interval: float = 0.05) -> None:
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        stats.loop_lags.append(max(0.0, time.perf_counter() - started - interval))
+
+
+async def monitor_rss(stats: LoadStats, stop: asyncio.Event, started: float, interval: float) -> None:
+    while not stop.is_set():
+        stats.rss_samples.append((time.perf_counter() - started, current_rss(), stats.completed))
+        try:
+            await asyncio.wait_for(stop.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+    stats.rss_samples.append((time.perf_counter() - started, current_rss(), stats.completed))
+
+# ============================================================
+# 📊 ОТЧЁТ
+# ============================================================
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def print_report(stats: LoadStats, api: FakeBotAPI, elapsed: float, users: int) -> None:
+    print(f"\n📊 Итоги: {users} пользователей, {elapsed:.1f} с")
+    print(f"Обслужено действий: {stats.completed}, таймаутов: {sum(stats.timeouts.values())}")
+    print(f"Пропускная способность: {stats.completed / elapsed:.1f} действий/с\n")
+
+    print(f"{'действие':<10} {'кол-во':>7} {'p50 мс':>8} {'p90 мс':>8} {'p99 мс':>8} {'max мс':>8} {'таймауты':>9}")
+    all_latencies = []
+    for kind in sorted(set(stats.latencies) | set(stats.timeouts)):
+        values = stats.latencies.get(kind, [])
+        all_latencies.extend(values)
+        print(
+            f"{kind:<10} {len(values):>7} {percentile(values, 50) * 1000:>8.1f} {percentile(values, 90) * 1000:>8.1f} "
+            f"{percentile(values, 99) * 1000:>8.1f} {max(values, default=0) * 1000:>8.1f} {stats.timeouts[kind]:>9}"
+        )
+    print(
+        f"{'всего':<10} {len(all_latencies):>7} {percentile(all_latencies, 50) * 1000:>8.1f} "
+        f"{percentile(all_latencies, 90) * 1000:>8.1f} {percentile(all_latencies, 99) * 1000:>8.1f} "
+        f"{max(all_latencies, default=0) * 1000:>8.1f} {sum(stats.timeouts.values()):>9}"
+    )
+
+    lags = stats.loop_lags
+    print(
+        f"\n⏱ Лаг event loop: p50 {percentile(lags, 50) * 1000:.1f} мс, p99 {percentile(lags, 99) * 1000:.1f} мс, "
+        f"max {max(lags, default=0) * 1000:.1f} мс"
+    )
+
+    print("\n🧠 RSS во времени:")
+    print(f"{'t, с':>7} {'RSS, МБ':>9} {'действий/с':>11}")
+    previous_t, previous_done = 0.0, 0
+    for t, rss, done in stats.rss_samples:
+        rate = (done - previous_done) / (t - previous_t) if t > previous_t else 0.0
+        print(f"{t:>7.1f} {rss / 2**20:>9.1f} {rate:>11.1f}")
+        previous_t, previous_done = t, done
+
+    print("\n📡 Запросы к Bot API:")
+    for method, count in api.calls.most_common():
+        print(f"  {method:<24} {count}")
+
+# ============================================================
+# 🚀 ЗАПУСК
+# ============================================================
+
+def parse_mix(raw: str) -> List[Tuple[str, float]]:
+    mix = []
+    for part in raw.split(","):
+        kind, _, weight = part.partition("=")
+        kind = kind.strip()
+        if kind not in ("message", "menu", "feedback"):
+            raise ValueError(f"Неизвестный тип действия: {kind}")
+        mix.append((kind, float(weight or 1)))
+    return mix
+
+
+async def run_load_test(args: argparse.Namespace) -> None:
+    # Каждый запрос к фейковому API иначе попадает в лог на уровне INFO
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    kb_path = os.path.abspath(args.kb)
+    main.kb_index = main.preprocess_knowledge_base(main.iter_knowledge_base(kb_path))
+    # Замкнутый цикл ждёт ответа на каждое действие: отброшенные обновления выглядели бы как таймауты
+    main.flood_control.enabled = args.flood_control
+
+    # Обработчики пишут заявки, отзывы и неизвестные вопросы в текущий каталог — уводим их во временный
+    workdir = tempfile.mkdtemp(prefix="progress_loadtest_")
+    os.chdir(workdir)
+
+    api = FakeBotAPI(latency=args.api_latency / 1000)
+    api.start()
+    application = main.build_application(FAKE_TOKEN, base_url=f"http://127.0.0.1:{api.port}/bot")
+    factory = UpdateFactory(main.kb_index, args.seed)
+    stats = LoadStats()
+    mix = parse_mix(args.mix)
+
+    await application.initialize()
+    await main.on_startup(application)
+    await application.start()
+
+    stop = asyncio.Event()
+    started = time.perf_counter()
+    monitors = [
+        asyncio.create_task(monitor_loop_lag(stats, stop)),
+        asyncio.create_task(monitor_rss(stats, stop, started, args.sample_interval)),
+    ]
+    deadline = started + args.duration
+    await asyncio.gather(*[
+        simulate_user(application, api, factory, stats, FIRST_USER_ID + i, mix, deadline, args.think_time, args.timeout)
+        for i in range(args.users)
+    ])
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await asyncio.gather(*monitors)
+
+    await application.stop()
+    await main.on_shutdown(application)
+    await application.shutdown()
+    api.stop()
+
+    print_report(stats, api, elapsed, args.users)
+    if args.flood_control:
+        print(f"Отсечено флуд-контролем: {dict(main.flood_control.shed)}")
+    print(f"\nФайлы данных теста: {workdir}")
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест Прогресс Бота на фейковом Bot API")
+    parser.add_argument("--users", type=int, default=20, help="число одновременных пользователей")
+    parser.add_argument("--duration", type=float, default=30, help="длительность теста, с")
+    parser.add_argument("--mix", default="message=0.6,menu=0.3,feedback=0.1", help="доли действий")
+    parser.add_argument("--think-time", type=float, default=1.0, help="средняя пауза пользователя между действиями, с")
+    parser.add_argument("--timeout", type=float, default=15.0, help="сколько ждать ответа бота, с")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка фейкового Bot API, мс")
+    parser.add_argument("--sample-interval", type=float, default=1.0, help="период замера RSS, с")
+    parser.add_argument("--kb", default="main.json", help="файл базы знаний")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--flood-control", action="store_true", help="включить лимиты входящих обновлений")
+    asyncio.run(run_load_test(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -7,29 +7,51 @@
 """
 
 import json
+import html
 import re
 import numpy as np
 import warnings
 import logging
 import traceback
+import cProfile
+import pstats
+import threading
 import asyncio  # Для статуса "печатает"
-from typing import Dict, List, Set, Optional, Tuple, Any
+from typing import Dict, List, Set, Optional, Tuple, Any, Iterable, Iterator
 import math
+import mmap
 import time
 import os
+import sys
+import argparse
+import multiprocessing
+import tempfile
+import random
+import zlib
+import hashlib
+import itertools
+import contextlib
+import signal
 from pathlib import Path
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
-from collections import deque
+from collections import Counter, OrderedDict, deque
 
 # Загрузка переменных окружения
 load_dotenv()
 
 import pymorphy2
+import scipy.sparse as sp
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+from telegram.ext import Application, BaseHandler, BaseUpdateProcessor, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
+
+# Межпроцессная блокировка файлов данных (воркеры супервизора пишут одни и те же файлы)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # Импорт для нечеткого поиска
 try:
@@ -50,15 +72,98 @@ warnings.filterwarnings('ignore', category=UserWarning, module='sklearn')
 
 # --- КОНСТАНТЫ ---
 ADMIN_USER_ID = 1373472999  # Замените на свой ID
+KB_FILE = os.getenv("KB_FILE", "main.json")  # .json — массив записей, .jsonl — запись на строку
 CONSULTATIONS_FILE = "consultations.json"
 UNKNOWN_FILE = "unknown_questions.json"
 FEEDBACK_FILE = "feedback.json"
+FEEDBACK_STATS_FILE = "feedback_stats.json"  # Счётчики 👍/👎 по записям базы знаний
 CALENDAR_URL = "https://calendar.app.google/ThpteAc5uqhxqnUA9"
 SITE_URL = "https://avick23.github.io/Business-card/"
 
 ITEMS_PER_PAGE = 5
 MAX_HISTORY_LENGTH = 5
 INACTIVITY_LIMIT_HOURS = 24
+CONTEXT_TURNS = 2      # Сколько прошлых реплик учитывается в уточняющем вопросе
+CONTEXT_DECAY = 0.5    # Вес реплики k шагов назад: CONTEXT_DECAY ** k
+EXACT_MATCH_SCORE = 10.0  # Точное совпадение с ключевой фразой — уверенный ответ без уточнений
+
+# Запросы кнопок главного меню: ответы на них считаются заранее при построении индекса
+MENU_QUERIES = {
+    "menu_cost": "стоимость",
+    "menu_method": "метод выстраданного познания",
+    "menu_about": "кто такой алексей"
+}
+
+# Общий индекс для нескольких воркеров: /dev/shm живёт в RAM, страницы делятся между процессами
+SHARED_INDEX_DIR = os.getenv(
+    "SHARED_INDEX_DIR",
+    "/dev/shm/progress_bot_index" if os.path.isdir("/dev/shm") else os.path.join(tempfile.gettempdir(), "progress_bot_index")
+)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WORKER_RESTART_DELAY = 5
+
+# Исходящие запросы к Bot API (лимиты Telegram: ~30 сообщений/с всего, ~1/с в один чат)
+OUTBOUND_WORKERS = 8
+OUTBOUND_POOL_SIZE = 16
+OUTBOUND_QUEUE_SIZE = 1000
+OUTBOUND_GLOBAL_RATE = 25.0
+OUTBOUND_PER_CHAT_RATE = 1.0
+OUTBOUND_PER_CHAT_BURST = 3
+OUTBOUND_MAX_CHAT_BUCKETS = 10000
+OUTBOUND_MAX_RETRIES = 3
+OUTBOUND_RETRY_BASE_DELAY = 0.5
+OUTBOUND_DRAIN_TIMEOUT = 5.0
+
+# Защита от флуда: входящие сообщения и нажатия кнопок до поиска и записи файлов
+FLOOD_USER_RATE = 1.0        # обновлений в секунду от одного пользователя
+FLOOD_USER_BURST = 5
+FLOOD_GLOBAL_RATE = 50.0     # обновлений в секунду от всех вместе
+FLOOD_GLOBAL_BURST = 100
+FLOOD_MAX_USER_BUCKETS = 10000
+
+# Планировщик обновлений: кнопки и команды обрабатываются сразу, поиск — ограниченным числом слотов
+UPDATE_MAX_CONCURRENT = 512   # всего обновлений в обработке одновременно
+SEARCH_CONCURRENCY = 4        # текстовых вопросов (поиск, fuzzy) одновременно
+SEARCH_QUEUE_SIZE = 200       # сверх этого вопросы в очереди получают отказ "перегружен"
+
+# Каскад поиска: отбор кандидатов по постингам, дешёвые ключевые слова, полнотекстовый TF-IDF — только если они не уверены
+CONFIDENT_SCORE = 3.5            # выше — отвечаем без уточнений
+CASCADE_EARLY_EXIT = True        # уверенный ответ по ключевым словам — без полнотекстового этапа
+SEARCH_TIME_BUDGET_SECONDS = 0.5 # после бюджета этапы, которые ещё не начались, пропускаются
+PHRASE_PREFIX_CHARS = 3          # ключевые фразы ищутся в вопросе через словарь по первым символам
+
+# Загрузка больших баз: файл читается кусками, индекс ключевых слов строится блоками записей
+KB_READ_CHUNK_CHARS = 1 << 20
+KB_INDEX_CHUNK_SIZE = 5000
+KB_VOCAB_CANDIDATES_FACTOR = 20  # сколько кандидатов в словарь TF-IDF держать на одно место max_features
+
+# Правки базы знаний по одной записи: IDF не пересчитывается на каждую правку, а догоняется в фоне
+KB_REFIT_INTERVAL_SECONDS = 600
+KB_SYNC_INTERVAL_SECONDS = 30    # как часто воркер проверяет, не изменил ли базу другой воркер
+
+# Сводки для администратора: события внутри окна склеиваются в одно сообщение
+ADMIN_DIGEST_WINDOW_SECONDS = 60
+ADMIN_DIGEST_TOP_ITEMS = 5
+ADMIN_URGENT_CONSULTATIONS = True  # Новые заявки приходят сразу, минуя окно
+
+# Профилирование по команде администратора
+PROFILES_DIR = "profiles"
+PROFILE_DEFAULT_UPDATES = 100
+PROFILE_DEFAULT_SECONDS = 60
+PROFILE_MAX_SECONDS = 600
+PROFILE_TOP_FUNCTIONS = 15
+
+# Неизвестные вопросы: почти-дубликаты склеиваются в одну запись со счётчиком
+UNKNOWN_MINHASH_PERMUTATIONS = 16
+UNKNOWN_LSH_BANDS = 8
+UNKNOWN_DUPLICATE_JACCARD = 0.7
+UNKNOWN_ANALYZED_CACHE_SIZE = 5000  # разобранных вопросов в памяти (LRU), чтобы перечитывание файла не лемматизировало заново
+
+# Оценки ответов как поправка к ранжированию: (лайки − дизлайки) / (всего + сглаживание) × вес
+FEEDBACK_PRIOR_WEIGHT = 0.3     # 0 — не учитывать оценки в поиске
+FEEDBACK_PRIOR_SMOOTHING = 5
+FEEDBACK_STATS_REFRESH_SECONDS = 10  # как часто поиск подхватывает оценки, посчитанные другими воркерами
 
 morph = pymorphy2.MorphAnalyzer()
 
@@ -144,6 +249,8 @@ class AppleStyleMessages:
     FEEDBACK_DISLIKE = "📝 Спасибо за обратную связь. Мы постараемся улучшить ответы."
     CLARIFY_PROMPT = "🤔 Уточните, пожалуйста:"
     FUZZY_SUGGESTION = "💡 Возможно, вы имели в виду:"
+    FLOOD_WARNING = "⏳ Слишком много сообщений. Подождите пару секунд."
+    SEARCH_BUSY = "⏳ Сейчас очень много вопросов. Повторите, пожалуйста, через минуту."
 
 
 # ============================================================
@@ -161,12 +268,37 @@ def load_json(file_path: str) -> list:
         return []
 
 def save_json(file_path: str, data: list) -> None:
+    # Временный файл и os.replace: другой воркер, читающий файл в этот момент, не увидит его наполовину записанным
+    tmp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
     try:
-        with open(file_path, "w", encoding="utf-8") as f:
+        with open(tmp_path, "w", encoding="utf-8") as f:
             json.dump(data, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, file_path)
     except IOError as e:
         logger.error(f"Error saving {file_path}: {e}")
 
+@contextlib.contextmanager
+def file_lock(file_path: str):
+    """Эксклюзивная блокировка <file>.lock между процессами на время чтения-изменения-записи файла."""
+    if fcntl is None:
+        # Без fcntl (Windows) супервизор с воркерами не запускается — файлы пишет один процесс
+        yield
+        return
+    with open(f"{file_path}.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def file_version(file_path: str) -> Optional[Tuple[int, int, int]]:
+    """Меняется при каждой записи файла (save_json заменяет inode); None — файла нет."""
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
 # ============================================================
 # 🧠 NLP ФУНКЦИИ
 # ============================================================
@@ -190,12 +322,75 @@ def expand_with_synonyms(keywords: Set[str]) -> Set[str]:
                 expanded.update([base] + synonyms)
     return expanded
 
-def load_knowledge_base(file_path: str) -> list:
+def _iter_json_array(f, chunk_chars: int = KB_READ_CHUNK_CHARS) -> Iterator[dict]:
+    """
+    Записи JSON-массива по одной: в памяти только текущий кусок файла, а не весь документ.
+    Синтаксис массива проверяется так же строго, как в json.load: "[1,,2]", "[1 2]" и "[1,]" — ошибки.
+    """
+    decoder = json.JSONDecoder()
+    buffer, pos, eof = "", 0, False
+    # Что ждём дальше: "[" — начало массива, "first" — запись или "]", "value" — запись, "sep" — "," или "]"
+    expect = "["
+    while True:
+        while pos < len(buffer) and buffer[pos] in " \t\r\n":
+            pos += 1
+        if pos == len(buffer):
+            if eof:
+                if expect == "end":
+                    return
+                raise ValueError("Неожиданный конец файла базы знаний")
+            chunk = f.read(chunk_chars)
+            eof = not chunk
+            buffer, pos = chunk, 0
+            continue
+        char = buffer[pos]
+        if expect == "end":
+            raise ValueError(f"Лишние данные после массива в базе знаний: {char!r}")
+        if expect == "[":
+            if char != "[":
+                raise ValueError("База знаний в формате .json должна быть массивом записей")
+            expect, pos = "first", pos + 1
+            continue
+        if expect in ("first", "sep") and char == "]":
+            expect, pos = "end", pos + 1
+            continue
+        if expect == "sep":
+            if char != ",":
+                raise ValueError(f"Ожидалась запятая между записями базы знаний, а не {char!r}")
+            expect, pos = "value", pos + 1
+            continue
+        try:
+            entry, end = decoder.raw_decode(buffer, pos)
+            # Число на границе куска могло прочитаться не целиком — дочитываем и разбираем заново
+            complete = end < len(buffer) or eof
+        except json.JSONDecodeError:
+            # Запись не уместилась в прочитанный кусок — дочитываем
+            if eof:
+                raise
+            complete = False
+        if not complete:
+            chunk = f.read(chunk_chars)
+            eof = not chunk
+            buffer, pos = buffer[pos:] + chunk, 0
+            continue
+        expect, pos = "sep", end
+        yield entry
+
+def iter_knowledge_base(file_path: str) -> Iterator[dict]:
+    """Записи базы знаний по одной; .jsonl читается построчно, остальное — как JSON-массив."""
     path = Path(file_path)
     if not path.exists():
         raise FileNotFoundError(f"Файл базы знаний не найден: {file_path}")
     with open(file_path, 'r', encoding='utf-8') as f:
-        return json.load(f)
+        if path.suffix == ".jsonl":
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from _iter_json_array(f)
+
+def load_knowledge_base(file_path: str) -> list:
+    return list(iter_knowledge_base(file_path))
 
 def preprocess_text(text: str) -> str:
     # Убираем HTML теги для NLP поиска, но не для вывода
@@ -220,6 +415,10 @@ def lemmatize_sentence(text: str) -> str:
     lemmas = [lemmatize_word(word) for word in words if word not in RUSSIAN_STOPWORDS and len(word) > 2]
     return " ".join(lemmas)
 
+def normalize_phrase(text: str) -> str:
+    """Ключ таблицы точных совпадений: нижний регистр, без вводных слов, пунктуации и лишних пробелов."""
+    return " ".join(preprocess_text(preprocess_question(text)).split())
+
 def extract_keywords(text: str, use_synonyms: bool = True) -> set:
     cleaned_text = preprocess_text(text)
     words = cleaned_text.split()
@@ -228,17 +427,15 @@ def extract_keywords(text: str, use_synonyms: bool = True) -> set:
         keywords = expand_with_synonyms(keywords)
     return keywords
 
-def calculate_keyword_match_score(user_keywords: Set[str], item_keywords: Set[str], 
-                                   user_question: str, original_keywords: List[str]) -> float:
-    common_keywords = user_keywords.intersection(item_keywords)
-    base_score = len(common_keywords) * 2
-    question_lower = preprocess_text(user_question)
-    phrase_bonus = 0
+def keyword_phrases(original_keywords: Iterable[str]) -> Dict[str, int]:
+    """Нормализованные ключевые фразы записи и бонус за каждую: 3 за слово (повтор фразы — ещё раз)."""
+    phrases: Dict[str, int] = {}
     for orig_keyword in original_keywords:
         keyword_lower = preprocess_text(orig_keyword)
-        if keyword_lower in question_lower:
-            phrase_bonus += len(keyword_lower.split()) * 3
-    return base_score + phrase_bonus
+        bonus = len(keyword_lower.split()) * 3
+        if bonus:
+            phrases[keyword_lower] = phrases.get(keyword_lower, 0) + bonus
+    return phrases
 
 # ============================================================
 # ✨ ОБРАБОТКА ТЕКСТА И КНОПОК (APPLE MAGIC)
@@ -320,122 +517,709 @@ def generate_smart_buttons(text: str) -> List[List[InlineKeyboardButton]]:
 # 📚 КЛАСС ИНДЕКСА БАЗЫ ЗНАНИЙ
 # ============================================================
 
+def make_labeled_vectorizer() -> TfidfVectorizer:
+    return TfidfVectorizer(
+        lowercase=True,
+        stop_words=list(RUSSIAN_STOPWORDS),
+        ngram_range=(1, 3),
+        max_features=3000,
+        dtype=np.float32
+    )
+
+def make_raw_vectorizer() -> TfidfVectorizer:
+    return TfidfVectorizer(
+        lowercase=True,
+        stop_words=list(RUSSIAN_STOPWORDS),
+        ngram_range=(1, 2),
+        max_features=2000,
+        dtype=np.float32
+    )
+
+def _streaming_vocabulary(vectorizer: TfidfVectorizer, documents: Iterable[str]) -> List[str]:
+    """
+    Словарь из max_features самых частых n-грамм без матрицы по всем n-граммам корпуса.
+    Счётчик раз в KB_INDEX_CHUNK_SIZE документов урезается до самых частых кандидатов,
+    поэтому память ограничена размером блока, а не базы; редкие n-граммы могут потерять часть счёта.
+    """
+    analyzer = vectorizer.build_analyzer()
+    limit = vectorizer.max_features * KB_VOCAB_CANDIDATES_FACTOR
+    counts: Counter = Counter()
+    for i, document in enumerate(documents, start=1):
+        counts.update(analyzer(document))
+        if i % KB_INDEX_CHUNK_SIZE == 0 and len(counts) > limit:
+            counts = Counter(dict(counts.most_common(limit)))
+    return sorted(term for term, _ in counts.most_common(vectorizer.max_features))
+
+def fit_tfidf(vectorizer: TfidfVectorizer, documents, n_documents: int):
+    """
+    Обучает векторизатор; documents() каждый раз отдаёт новый генератор текстов.
+    Большая база проходится дважды: сначала словарь, потом матрица только по его столбцам.
+    """
+    if n_documents > KB_INDEX_CHUNK_SIZE:
+        vectorizer.set_params(vocabulary=_streaming_vocabulary(vectorizer, documents()))
+    return vectorizer.fit_transform(documents())
+
+def unit_rows_cosine(vecs, matrix) -> np.ndarray:
+    """
+    Косинус запросов (строки vecs) со строками матрицы TF-IDF, результат — записи × запросы.
+    Строки уже нормированы векторизатором (norm='l2'), поэтому нормируются только запросы —
+    cosine_similarity копировал бы и нормировал всю матрицу. Пакет запросов — одно матричное умножение.
+    """
+    similarities = (matrix @ vecs.T).toarray()
+    for col in range(vecs.shape[0]):
+        row = vecs.data[vecs.indptr[col]:vecs.indptr[col + 1]]
+        norm = float(np.sqrt(np.dot(row, row)))
+        if norm:
+            similarities[:, col] /= norm
+    return similarities
+
+def _posting_rows(postings, term_ids) -> np.ndarray:
+    """Записи, в которых есть хотя бы один из терминов (строки постингов term_ids), с повторами."""
+    indptr, indices = postings.indptr, postings.indices
+    rows = [indices[indptr[t]:indptr[t + 1]] for t in term_ids]
+    return np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+
+def kb_item_id(context: str) -> str:
+    return hashlib.sha1(context.encode("utf-8")).hexdigest()[:12]
+
+class KBItem:
+    """
+    Запись базы знаний. Леммы ключевых слов хранятся не здесь, а строкой в KBIndex.keyword_matrix.
+    item_id не зависит от позиции в main.json: поле "id" записи или хэш текста ответа.
+    """
+    __slots__ = ("context", "original_keywords", "item_id")
+
+    def __init__(self, context: str, original_keywords: List[str], item_id: Optional[str] = None):
+        self.context = context
+        self.original_keywords = tuple(original_keywords)
+        self.item_id = item_id or kb_item_id(context)
+
+class SharedKBItem(KBItem):
+    """
+    Запись подключённого общего индекса: текст ответа не копируется в воркер, а декодируется
+    из общего contexts.npy (mmap) при обращении. Тексты — основная часть памяти индекса.
+    """
+    __slots__ = ("blob", "start", "end")
+
+    def __init__(self, blob: np.ndarray, start: int, end: int, original_keywords: List[str], item_id: str):
+        self.blob = blob
+        self.start = start
+        self.end = end
+        self.original_keywords = tuple(original_keywords)
+        self.item_id = item_id
+
+    @property
+    def context(self) -> str:
+        return self.blob[self.start:self.end].tobytes().decode("utf-8")
+
+# Каждый KBIndex получает новый номер: по нему сбрасываются кэши, посчитанные для другой версии базы
+_kb_versions = itertools.count(1)
+
 class KBIndex:
     def __init__(self):
-        self.items = []
-        self.contexts = []
+        self.version = next(_kb_versions)
+        # Правки после последнего обучения TF-IDF: их IDF устарел до фонового переобучения
+        self.stale_edits = 0
+        # Версия файла базы (file_version), из которой опубликован подключённый индекс
+        self.source_version: Optional[Tuple[int, int, int]] = None
+        self.items: List[KBItem] = []
+        # Леммы ключевых слов интернированы в целые id
+        self.lemma_ids: Dict[str, int] = {}
+        self.lemma_terms: List[str] = []
+        # Строка i — отсортированные id лемм записи i (CSR: indices каждой строки упорядочены)
+        self.keyword_matrix = None
         self.tfidf_vectorizer = None
         self.tfidf_labeled_matrix = None
         self.raw_tfidf_vectorizer = None
         self.tfidf_raw_matrix = None
+        # Постинги — транспонированные keyword_matrix и матрицы TF-IDF в CSR: строка t — записи с термином t.
+        # По ним каскад отбирает кандидатов, не умножая вопрос на всю базу
+        self.keyword_postings = None
+        self.labeled_postings = None
+        self.raw_postings = None
         self.all_keywords_list = []
-    
+        # Сколько записей содержат ключевую фразу: по нему правка записи обновляет all_keywords_list
+        self.keyword_counts: Counter = Counter()
+        # Ключевые фразы после preprocess_text, интернированы в id; строка i phrase_matrix — бонусы фраз записи i
+        self.phrase_ids: Dict[str, int] = {}
+        self.phrase_terms: List[str] = []
+        # Первые PHRASE_PREFIX_CHARS символов фразы (или вся короткая фраза) -> id фраз
+        self.phrase_prefixes: Dict[str, Tuple[int, ...]] = {}
+        self.phrase_matrix = None
+        # Точные совпадения: нормализованная фраза -> запись, и готовые ответы кнопок меню
+        self.exact_phrases: Dict[str, int] = {}
+        # Нормализованные ключевые фразы каждой записи — чтобы правка не нормализовала всю базу заново
+        self.item_phrases: List[Tuple[str, ...]] = []
+        self.canned_answers: Dict[str, Tuple[Optional[str], float, List[dict]]] = {}
+
+    def intern_lemma(self, lemma: str) -> int:
+        lemma_id = self.lemma_ids.get(lemma)
+        if lemma_id is None:
+            lemma_id = len(self.lemma_terms)
+            self.lemma_ids[lemma] = lemma_id
+            self.lemma_terms.append(lemma)
+        return lemma_id
+
+    def intern_phrase(self, phrase: str) -> int:
+        phrase_id = self.phrase_ids.get(phrase)
+        if phrase_id is None:
+            phrase_id = len(self.phrase_terms)
+            self.phrase_ids[phrase] = phrase_id
+            self.phrase_terms.append(phrase)
+            prefix = phrase[:PHRASE_PREFIX_CHARS]
+            # Новый кортеж, а не append: copy() делит кортежи префиксов между версиями индекса
+            self.phrase_prefixes[prefix] = self.phrase_prefixes.get(prefix, ()) + (phrase_id,)
+        return phrase_id
+
+    def copy(self) -> "KBIndex":
+        """Новая версия индекса с общими (не копируемыми) матрицами и векторизаторами."""
+        clone = KBIndex()
+        clone.stale_edits = self.stale_edits
+        clone.items = list(self.items)
+        clone.lemma_ids = dict(self.lemma_ids)
+        clone.lemma_terms = list(self.lemma_terms)
+        clone.keyword_matrix = self.keyword_matrix
+        clone.phrase_ids = dict(self.phrase_ids)
+        clone.phrase_terms = list(self.phrase_terms)
+        clone.phrase_prefixes = dict(self.phrase_prefixes)
+        clone.phrase_matrix = self.phrase_matrix
+        clone.tfidf_vectorizer = self.tfidf_vectorizer
+        clone.tfidf_labeled_matrix = self.tfidf_labeled_matrix
+        clone.raw_tfidf_vectorizer = self.raw_tfidf_vectorizer
+        clone.tfidf_raw_matrix = self.tfidf_raw_matrix
+        clone.keyword_postings = self.keyword_postings
+        clone.labeled_postings = self.labeled_postings
+        clone.raw_postings = self.raw_postings
+        clone.all_keywords_list = self.all_keywords_list
+        clone.keyword_counts = Counter(self.keyword_counts)
+        clone.exact_phrases = dict(self.exact_phrases)
+        clone.item_phrases = list(self.item_phrases)
+        clone.canned_answers = self.canned_answers
+        return clone
+
+    def item_keyword_ids(self, idx: int) -> np.ndarray:
+        start, end = self.keyword_matrix.indptr[idx], self.keyword_matrix.indptr[idx + 1]
+        return self.keyword_matrix.indices[start:end]
+
+    def item_keywords(self, idx: int) -> Set[str]:
+        return {self.lemma_terms[lemma_id] for lemma_id in self.item_keyword_ids(idx)}
+
     def build_tfidf_index(self, contexts: List[str]):
-        self.tfidf_vectorizer = TfidfVectorizer(
-            lowercase=True, 
-            stop_words=list(RUSSIAN_STOPWORDS), 
-            ngram_range=(1, 3), 
-            max_features=3000
-        )
-        # Лемматизируем только для TF-IDF
-        lemmatized_contexts = [lemmatize_sentence(ctx) for ctx in contexts]
-        self.tfidf_labeled_matrix = self.tfidf_vectorizer.fit_transform(lemmatized_contexts)
-        
-        self.raw_tfidf_vectorizer = TfidfVectorizer(
-            lowercase=True, 
-            stop_words=list(RUSSIAN_STOPWORDS), 
-            ngram_range=(1, 2), 
-            max_features=2000
+        self.tfidf_vectorizer = make_labeled_vectorizer()
+        # Лемматизируем только для TF-IDF; генератор — векторизатору не нужен список всех лемматизированных текстов
+        self.tfidf_labeled_matrix = fit_tfidf(
+            self.tfidf_vectorizer, lambda: (lemmatize_sentence(ctx) for ctx in contexts), len(contexts)
         )
-        self.tfidf_raw_matrix = self.raw_tfidf_vectorizer.fit_transform(contexts)
-        
-        all_kw = set()
+
+        self.raw_tfidf_vectorizer = make_raw_vectorizer()
+        self.tfidf_raw_matrix = fit_tfidf(self.raw_tfidf_vectorizer, lambda: iter(contexts), len(contexts))
+
+        self.build_keywords_list()
+
+    def build_postings(self):
+        self.keyword_postings = self.keyword_matrix.T.tocsr()
+        self.labeled_postings = self.tfidf_labeled_matrix.T.tocsr()
+        self.raw_postings = self.tfidf_raw_matrix.T.tocsr()
+
+    def build_keywords_list(self):
+        self.keyword_counts = Counter()
         for item in self.items:
-            all_kw.update(item["original_keywords"])
-        self.all_keywords_list = list(all_kw)
+            self.keyword_counts.update(set(item.original_keywords))
+        self.all_keywords_list = list(self.keyword_counts)
+
+    def update_keywords_list(self, old_keywords: Iterable[str], new_keywords: Iterable[str]) -> None:
+        """all_keywords_list после замены ключевых фраз одной записи."""
+        old_keywords, new_keywords = set(old_keywords), set(new_keywords)
+        if old_keywords == new_keywords:
+            return
+        self.keyword_counts.subtract(old_keywords)
+        self.keyword_counts.update(new_keywords)
+        for keyword in old_keywords - new_keywords:
+            if self.keyword_counts[keyword] <= 0:
+                del self.keyword_counts[keyword]
+        self.all_keywords_list = list(self.keyword_counts)
+
+    def build_phrase_index(self):
+        """preprocess_text каждой ключевой фразы — один раз при построении, а не на каждый вопрос."""
+        self.phrase_ids, self.phrase_terms = {}, []
+        prefixes: Dict[str, List[int]] = {}
+        rows, cols, bonuses = [], [], []
+        for idx, item in enumerate(self.items):
+            for phrase, bonus in keyword_phrases(item.original_keywords).items():
+                phrase_id = self.phrase_ids.get(phrase)
+                if phrase_id is None:
+                    phrase_id = len(self.phrase_terms)
+                    self.phrase_ids[phrase] = phrase_id
+                    self.phrase_terms.append(phrase)
+                    prefixes.setdefault(phrase[:PHRASE_PREFIX_CHARS], []).append(phrase_id)
+                rows.append(idx)
+                cols.append(phrase_id)
+                bonuses.append(bonus)
+        self.phrase_prefixes = {prefix: tuple(ids) for prefix, ids in prefixes.items()}
+        self.phrase_matrix = sp.csr_matrix(
+            (np.array(bonuses, dtype=np.float32), (np.array(rows, dtype=np.int32), np.array(cols, dtype=np.int32))),
+            shape=(len(self.items), len(self.phrase_terms))
+        )
+
+    def found_phrases(self, question_lower: str) -> Set[int]:
+        """id ключевых фраз, целиком входящих в вопрос. Проверяются только фразы, начало которых есть в вопросе."""
+        found = set()
+        for pos in range(len(question_lower)):
+            for length in range(1, PHRASE_PREFIX_CHARS + 1):
+                for phrase_id in self.phrase_prefixes.get(question_lower[pos:pos + length], ()):
+                    if question_lower.startswith(self.phrase_terms[phrase_id], pos):
+                        found.add(phrase_id)
+        return found
+
+    def phrase_bonus(self, question_lower: str) -> np.ndarray:
+        """Бонус за ключевые фразы из вопроса для всех записей: phrase_matrix @ вектор найденных фраз."""
+        found = self.found_phrases(question_lower)
+        if not found:
+            return np.zeros(len(self.items), dtype=np.float32)
+        found_vector = np.zeros(len(self.phrase_terms), dtype=np.float32)
+        found_vector[list(found)] = 1.0
+        return self.phrase_matrix @ found_vector
+    
+    def keyword_scores(self, analysis: "QueryAnalysis") -> np.ndarray:
+        return self.keyword_overlap(analysis) + analysis.phrase_bonus(self)
+    
+    def keyword_overlap(self, analysis: "QueryAnalysis") -> np.ndarray:
+        """Взвешенное число общих лемм для всех записей сразу: keyword_matrix @ веса лемм вопроса."""
+        return (self.keyword_matrix @ self._lemma_vector(analysis)) * 2
+    
+    def _lemma_vector(self, analysis: "QueryAnalysis") -> np.ndarray:
+        user_vector = np.zeros(len(self.lemma_terms), dtype=np.float32)
+        for word, weight in analysis.keyword_weights.items():
+            lemma_id = self.lemma_ids.get(word)
+            if lemma_id is not None:
+                user_vector[lemma_id] = weight
+        return user_vector
+    
+    def cascade_candidates(self, analysis: "QueryAnalysis") -> np.ndarray:
+        """
+        Первый этап каскада: записи с общей леммой ключевых слов, с ключевой фразой из вопроса
+        или хотя бы с одним термином TF-IDF вопроса (постинги), по возрастанию индекса.
+        У остальных записей и оценка по ключевым словам, и косинус нулевые, поэтому лучшие
+        среди кандидатов — те же, что по всей базе.
+        """
+        lemma_ids = [self.lemma_ids[word] for word in analysis.keyword_weights if word in self.lemma_ids]
+        hits = [
+            _posting_rows(self.keyword_postings, lemma_ids),
+            np.flatnonzero(analysis.phrase_bonus(self)) if analysis.keyword_weights else np.empty(0, dtype=np.int64),
+            _posting_rows(self.labeled_postings, analysis.labeled_vec.indices),
+            _posting_rows(self.raw_postings, analysis.raw_vec.indices),
+        ]
+        return np.unique(np.concatenate(hits))
     
-    def keyword_search(self, user_question: str, top_k: int = 3) -> List[dict]:
-        user_keywords = extract_keywords(user_question)
-        if not user_keywords:
+    def keyword_search(self, analysis: "QueryAnalysis", top_k: int = 3,
+                       candidates: Optional[np.ndarray] = None) -> List[dict]:
+        """candidates — оценивать только эти записи (по возрастанию индекса)."""
+        if not analysis.keyword_weights:
             return []
-        
+        if candidates is None:
+            return self._keyword_results(self.keyword_scores(analysis), np.arange(len(self.items)), top_k)
+        scores = (self.keyword_matrix[candidates] @ self._lemma_vector(analysis)) * 2 + analysis.phrase_bonus(self)[candidates]
+        return self._keyword_results(scores, candidates, top_k)
+    
+    def _keyword_results(self, scores: np.ndarray, candidates: np.ndarray, top_k: int) -> List[dict]:
         scored_items = []
-        for idx, item in enumerate(self.items):
-            score = calculate_keyword_match_score(
-                user_keywords, item["keywords"], user_question, item["original_keywords"]
-            )
-            if score > 0:
-                scored_items.append({"context": item["context"], "score": score, "index": idx})
-        
-        scored_items.sort(key=lambda x: x["score"], reverse=True)
-        return scored_items[:top_k]
+        for pos in np.argsort(-scores, kind="stable")[:top_k]:
+            if scores[pos] <= 0:
+                break
+            idx = int(candidates[pos])
+            scored_items.append({"context": self.items[idx].context, "score": float(scores[pos]), "index": idx})
+        return scored_items
+    
+    def keyword_search_batch(self, analyses: List["QueryAnalysis"], top_k: int = 3) -> List[List[dict]]:
+        """
+        keyword_search по всей базе для пакета реплик (без parts): веса лемм и найденные фразы
+        всех реплик — столбцы разреженных матриц, оценки — два матричных умножения на пакет.
+        """
+        lemma_rows, lemma_cols, lemma_weights = [], [], []
+        phrase_rows, phrase_cols = [], []
+        for col, analysis in enumerate(analyses):
+            for word, weight in analysis.keyword_weights.items():
+                lemma_id = self.lemma_ids.get(word)
+                if lemma_id is not None:
+                    lemma_rows.append(lemma_id)
+                    lemma_cols.append(col)
+                    lemma_weights.append(weight)
+            for phrase_id in self.found_phrases(analysis.question_lower):
+                phrase_rows.append(phrase_id)
+                phrase_cols.append(col)
+        user_vectors = sp.csr_matrix(
+            (np.array(lemma_weights, dtype=np.float32), (lemma_rows, lemma_cols)),
+            shape=(len(self.lemma_terms), len(analyses))
+        )
+        found_vectors = sp.csr_matrix(
+            (np.ones(len(phrase_rows), dtype=np.float32), (phrase_rows, phrase_cols)),
+            shape=(len(self.phrase_terms), len(analyses))
+        )
+        scores = (self.keyword_matrix @ user_vectors).toarray() * 2 + (self.phrase_matrix @ found_vectors).toarray()
+        candidates = np.arange(len(self.items))
+        return [
+            self._keyword_results(scores[:, col], candidates, top_k) if analysis.keyword_weights else []
+            for col, analysis in enumerate(analyses)
+        ]
     
-    def fulltext_search(self, query: str, top_k: int = 3) -> List[dict]:
+    def fulltext_search(self, analysis: "QueryAnalysis", top_k: int = 3,
+                        candidates: Optional[np.ndarray] = None) -> List[dict]:
+        """candidates — косинус только для этих записей (по возрастанию индекса)."""
         if self.tfidf_vectorizer is None or self.tfidf_labeled_matrix is None:
             return []
         try:
-            query_lemma = lemmatize_sentence(query)
-            query_vec = self.tfidf_vectorizer.transform([query_lemma])
-            labeled_similarities = cosine_similarity(query_vec, self.tfidf_labeled_matrix)[0]
-            
-            raw_query_vec = self.raw_tfidf_vectorizer.transform([query])
-            raw_similarities = cosine_similarity(raw_query_vec, self.tfidf_raw_matrix)[0]
+            labeled_matrix, raw_matrix = self.tfidf_labeled_matrix, self.tfidf_raw_matrix
+            if candidates is None:
+                candidates = np.arange(len(self.items))
+            else:
+                labeled_matrix, raw_matrix = labeled_matrix[candidates], raw_matrix[candidates]
+            labeled_similarities = unit_rows_cosine(analysis.labeled_vec, labeled_matrix)[:, 0]
+            raw_similarities = unit_rows_cosine(analysis.raw_vec, raw_matrix)[:, 0]
             
             combined_similarities = 0.7 * labeled_similarities + 0.3 * raw_similarities
-            top_indices = np.argsort(combined_similarities)[::-1][:top_k]
-            
-            results = []
-            for idx in top_indices:
-                score = combined_similarities[idx]
-                if score > 0.15:
-                    results.append({
-                        "context": self.contexts[idx], 
-                        "score": float(score), 
-                        "index": int(idx)
-                    })
-            return results
+            return self._fulltext_results(combined_similarities, candidates, top_k)
         except Exception as e:
             logger.error(f"Fulltext search error: {e}")
             return []
     
+    def _fulltext_results(self, combined_similarities: np.ndarray, candidates: np.ndarray, top_k: int) -> List[dict]:
+        results = []
+        # Из равных выше запись с меньшим индексом — порядок не зависит от того, по скольким записям считали
+        for pos in np.argsort(-combined_similarities, kind="stable")[:top_k]:
+            score = combined_similarities[pos]
+            if score > 0.15:
+                results.append({
+                    "context": self.items[candidates[pos]].context, 
+                    "score": float(score), 
+                    "index": int(candidates[pos])
+                })
+        return results
+    
+    def fulltext_search_batch(self, analyses: List["QueryAnalysis"], top_k: int = 3) -> List[List[dict]]:
+        """fulltext_search по всей базе для пакета реплик: векторы запросов складываются в матрицу."""
+        if not analyses:
+            return []
+        if self.tfidf_vectorizer is None or self.tfidf_labeled_matrix is None:
+            return [[] for _ in analyses]
+        try:
+            labeled_similarities = unit_rows_cosine(
+                sp.vstack([analysis.labeled_vec for analysis in analyses], format="csr"), self.tfidf_labeled_matrix
+            )
+            raw_similarities = unit_rows_cosine(
+                sp.vstack([analysis.raw_vec for analysis in analyses], format="csr"), self.tfidf_raw_matrix
+            )
+            combined_similarities = 0.7 * labeled_similarities + 0.3 * raw_similarities
+            candidates = np.arange(len(self.items))
+            return [self._fulltext_results(combined_similarities[:, col], candidates, top_k) for col in range(len(analyses))]
+        except Exception as e:
+            logger.error(f"Fulltext search error: {e}")
+            return [[] for _ in analyses]
+    
     def is_valid_index(self, idx: int) -> bool:
-        return 0 <= idx < len(self.items)
-
+        # Удалённая запись остаётся пустой строкой-надгробием, чтобы не сдвигать индексы в кнопках
+        return 0 <= idx < len(self.items) and bool(self.items[idx].context)
+    
+    def make_candidate(self, idx: int, score: float) -> dict:
+        item = self.items[idx]
+        topic_name = item.original_keywords[0] if item.original_keywords else "Тема"
+        return {"index": idx, "score": score, "topic": topic_name, "context": item.context}
+    
+    def build_exact_phrases(self):
+        self.item_phrases = [tuple(normalize_phrase(keyword) for keyword in item.original_keywords) for item in self.items]
+        self.exact_phrases = {phrase: idx for phrase, (_, idx) in self._best_phrase_owners().items()}
+
+    def _best_phrase_owners(self, phrases: Optional[Set[str]] = None) -> Dict[str, Tuple[int, int]]:
+        # Фраза из нескольких записей достаётся той, где она стоит ближе к началу списка ключей
+        best: Dict[str, Tuple[int, int]] = {}
+        for idx, item_phrases in enumerate(self.item_phrases):
+            for position, phrase in enumerate(item_phrases):
+                if phrase and (phrases is None or phrase in phrases) and (phrase not in best or (position, idx) < best[phrase]):
+                    best[phrase] = (position, idx)
+        return best
+
+    def update_exact_phrases(self, idx: int) -> None:
+        """Таблица точных фраз после правки записи idx: пересчитываются только её старые и новые фразы."""
+        phrases = tuple(normalize_phrase(keyword) for keyword in self.items[idx].original_keywords)
+        if idx == len(self.item_phrases):
+            self.item_phrases.append(phrases)
+            affected = set(phrases)
+        else:
+            affected = set(self.item_phrases[idx]) | set(phrases)
+            self.item_phrases[idx] = phrases
+        affected.discard("")
+        best = self._best_phrase_owners(affected)
+        for phrase in affected:
+            if phrase in best:
+                self.exact_phrases[phrase] = best[phrase][1]
+            else:
+                self.exact_phrases.pop(phrase, None)
+    
+    def exact_match(self, question: str) -> Optional[Tuple[Optional[str], float, List[dict]]]:
+        """O(1)-ответ на кнопку меню или точную ключевую фразу; None — нужен полный поиск."""
+        phrase = normalize_phrase(question)
+        canned = self.canned_answers.get(phrase)
+        if canned is not None:
+            return canned
+        idx = self.exact_phrases.get(phrase)
+        if idx is None:
+            return None
+        return self.items[idx].context, EXACT_MATCH_SCORE, [self.make_candidate(idx, EXACT_MATCH_SCORE)]
+
+
+def keyword_lemmas(keywords: List[str]) -> Set[str]:
+    processed_keywords = set()
+    for keyword in keywords:
+        for word in re.split(r'\s+', preprocess_text(keyword)):
+            if len(word) > 2 and word not in RUSSIAN_STOPWORDS:
+                processed_keywords.add(lemmatize_word(word))
+    return processed_keywords
+
+def _keyword_block(kb_index: KBIndex, rows: List[int], cols: List[int], start: int, end: int):
+    return sp.csr_matrix(
+        (np.ones(len(rows), dtype=np.uint8), (np.array(rows, dtype=np.int32) - start, np.array(cols, dtype=np.int32))),
+        shape=(end - start, len(kb_index.lemma_terms))
+    )
 
-def preprocess_knowledge_base(knowledge_base: list) -> KBIndex:
+def preprocess_knowledge_base(knowledge_base: Iterable[dict], chunk_size: int = KB_INDEX_CHUNK_SIZE) -> KBIndex:
+    """
+    Строит индекс из записей базы; принимает и список, и генератор (iter_knowledge_base).
+    Сырые записи не накапливаются: от каждой остаётся KBItem, а пары (запись, лемма)
+    каждые chunk_size записей сворачиваются в блок CSR.
+    """
     kb_index = KBIndex()
-    processed_items = []
-    contexts = [item["context"] for item in knowledge_base]
+    blocks = []
+    rows, cols = [], []
+    chunk_start = 0
     
     for i, item in enumerate(knowledge_base):
-        processed_keywords = set()
-        for keyword in item["keywords"]:
-            for word in re.split(r'\s+', preprocess_text(keyword)):
-                if len(word) > 2 and word not in RUSSIAN_STOPWORDS:
-                    processed_keywords.add(lemmatize_word(word))
-        item_data = {
-            "context": item["context"], 
-            "keywords": processed_keywords, 
-            "original_keywords": item["keywords"]
-        }
-        processed_items.append(item_data)
-    
-    kb_index.items = processed_items
-    kb_index.contexts = contexts
-    kb_index.build_tfidf_index(contexts)
+        if i - chunk_start == chunk_size:
+            blocks.append(_keyword_block(kb_index, rows, cols, chunk_start, i))
+            rows, cols = [], []
+            chunk_start = i
+        for lemma in keyword_lemmas(item["keywords"]):
+            rows.append(i)
+            cols.append(kb_index.intern_lemma(lemma))
+        kb_index.items.append(KBItem(item["context"], item["keywords"], item.get("id")))
+    blocks.append(_keyword_block(kb_index, rows, cols, chunk_start, len(kb_index.items)))
+    del rows, cols
+    
+    # Ранние блоки построены при меньшем словаре лемм — выравниваем число столбцов
+    n_lemmas = len(kb_index.lemma_terms)
+    blocks = [sp.csr_matrix((b.data, b.indices, b.indptr), shape=(b.shape[0], n_lemmas)) for b in blocks]
+    kb_index.keyword_matrix = sp.vstack(blocks, format="csr") if len(blocks) > 1 else blocks[0]
+    del blocks
+    kb_index.keyword_matrix.sort_indices()
+    kb_index.build_phrase_index()
+    kb_index.build_tfidf_index([item.context for item in kb_index.items])
+    kb_index.build_postings()
+    build_exact_match_index(kb_index)
     return kb_index
 
 
-def search_knowledge_base(user_question: str, kb_index: KBIndex) -> Tuple[Optional[str], float, List[dict]]:
-    cleaned_question = preprocess_question(user_question)
-    
-    keyword_results = kb_index.keyword_search(cleaned_question, top_k=5)
-    fulltext_results = kb_index.fulltext_search(cleaned_question, top_k=5)
-    
-    if not keyword_results and not fulltext_results:
-        keyword_results = kb_index.keyword_search(user_question, top_k=5)
-        fulltext_results = kb_index.fulltext_search(user_question, top_k=5)
-    
+def _deep_sizeof(obj: Any, seen: Set[int]) -> int:
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, np.ndarray):
+        base = obj
+        while isinstance(base, np.ndarray) and base.base is not None:
+            base = base.base
+        # Массивы, подключённые через mmap, лежат в общем page cache и процессу не принадлежат
+        if isinstance(base, mmap.mmap):
+            return sys.getsizeof(obj)
+        return obj.nbytes + sys.getsizeof(obj)
+    if sp.issparse(obj):
+        return sum(_deep_sizeof(getattr(obj, name), seen) for name in ("data", "indices", "indptr"))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_sizeof(k, seen) + _deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(_deep_sizeof(x, seen) for x in obj)
+    elif hasattr(obj, "__slots__"):
+        size += sum(_deep_sizeof(getattr(obj, name), seen) for name in obj.__slots__ if hasattr(obj, name))
+    return size
+
+def kb_memory_report(kb_index: KBIndex) -> Dict[str, Tuple[int, int]]:
+    """
+    Сравнивает компактное представление индекса с прежним:
+    список dict с set лемм, отдельный список contexts и матрицы float64.
+    Возвращает {компонент: (байт до, байт после)}.
+    """
+    legacy_items = [
+        {"context": item.context, "keywords": kb_index.item_keywords(i), "original_keywords": list(item.original_keywords)}
+        for i, item in enumerate(kb_index.items)
+    ]
+    legacy_contexts = [item.context for item in kb_index.items]
+
+    # Тексты ответов одинаковы в обоих вариантах — считаем их общими и не включаем в сравнение
+    seen_before = {id(item.context) for item in kb_index.items}
+    seen_after = set(seen_before)
+    report = {
+        "items": (
+            _deep_sizeof(legacy_items, seen_before) + _deep_sizeof(legacy_contexts, seen_before),
+            _deep_sizeof(kb_index.items, seen_after) + _deep_sizeof(kb_index.lemma_ids, seen_after)
+            + _deep_sizeof(kb_index.lemma_terms, seen_after) + _deep_sizeof(kb_index.keyword_matrix, seen_after)
+        ),
+        "tfidf_labeled": (
+            _deep_sizeof(kb_index.tfidf_labeled_matrix.astype(np.float64), set()),
+            _deep_sizeof(kb_index.tfidf_labeled_matrix, seen_after)
+        ),
+        "tfidf_raw": (
+            _deep_sizeof(kb_index.tfidf_raw_matrix.astype(np.float64), set()),
+            _deep_sizeof(kb_index.tfidf_raw_matrix, seen_after)
+        ),
+        # Постинги каскада — новая структура, в старом варианте их не было
+        "postings": (
+            0,
+            _deep_sizeof(kb_index.keyword_postings, seen_after) + _deep_sizeof(kb_index.labeled_postings, seen_after)
+            + _deep_sizeof(kb_index.raw_postings, seen_after)
+        ),
+    }
+    report["total"] = (sum(before for before, _ in report.values()), sum(after for _, after in report.values()))
+    return report
+
+def print_memory_report(kb_index: KBIndex) -> None:
+    count = max(len(kb_index.items), 1)
+    print(f"📦 Память индекса ({len(kb_index.items)} записей), байт на запись:")
+    for name, (before, after) in kb_memory_report(kb_index).items():
+        print(f"  {name:<14} до: {before / count:>9.1f}  после: {after / count:>9.1f}")
+
+
+class QueryAnalysis:
+    """
+    Разобранная реплика — всё, что нужно поиску, считается один раз на сообщение:
+    нормализованный текст, леммы, ключевые слова с синонимами (с весами) и разреженные TF-IDF векторы.
+    Сохраняется в сессии, чтобы уточняющий вопрос не разбирал прошлые реплики заново.
+    parts — для составного запроса: исходные реплики и их веса.
+    vectorizer — TF-IDF, которым посчитаны векторы: по нему сессия понимает, что векторы устарели.
+    Сам индекс не хранится, чтобы реплики в сессиях не удерживали в памяти старые версии базы.
+    """
+    __slots__ = ("text", "question_lower", "lemmas", "keyword_weights", "labeled_vec", "raw_vec", "vectorizer", "parts",
+                 "_phrase_bonus", "_phrase_bonus_version")
+
+    def __init__(self, text: str, question_lower: str, lemmas: List[str], keyword_weights: Dict[str, float],
+                 labeled_vec, raw_vec, vectorizer: TfidfVectorizer,
+                 parts: Optional[List[Tuple["QueryAnalysis", float]]] = None):
+        self.text = text
+        self.question_lower = question_lower
+        self.lemmas = lemmas
+        self.keyword_weights = keyword_weights
+        self.labeled_vec = labeled_vec
+        self.raw_vec = raw_vec
+        self.vectorizer = vectorizer
+        self.parts = parts
+        self._phrase_bonus = None
+        self._phrase_bonus_version = 0
+
+    def phrase_bonus(self, kb_index: KBIndex) -> np.ndarray:
+        """Бонус за совпадение целых ключевых фраз для всех записей; один раз на реплику и версию индекса."""
+        if self.parts:
+            return sum(weight * part.phrase_bonus(kb_index) for part, weight in self.parts)
+        if self._phrase_bonus is None or self._phrase_bonus_version != kb_index.version:
+            self._phrase_bonus = kb_index.phrase_bonus(self.question_lower)
+            self._phrase_bonus_version = kb_index.version
+        return self._phrase_bonus
+
+
+def _query_terms(text: str) -> Tuple[str, List[str], str]:
+    """Нормализованный текст, леммы и лемматизированный текст для TF-IDF."""
+    question_lower = preprocess_text(text)
+    lemmas = [
+        lemmatize_word(word) for word in question_lower.split()
+        if len(word) > 2 and word not in RUSSIAN_STOPWORDS
+    ]
+    # lemmatize_sentence отличается от тех же лемм, только если [?!.] склеивает соседние слова ("1.5", "сайт.ру")
+    lemmatized = lemmatize_sentence(text) if re.search(r'\S[?!.]+\S', text) else " ".join(lemmas)
+    return question_lower, lemmas, lemmatized
+
+def analyze_query(text: str, kb_index: KBIndex) -> QueryAnalysis:
+    question_lower, lemmas, lemmatized = _query_terms(text)
+    return QueryAnalysis(
+        text,
+        question_lower,
+        lemmas,
+        dict.fromkeys(expand_with_synonyms(set(lemmas)), 1.0),
+        kb_index.tfidf_vectorizer.transform([lemmatized]),
+        kb_index.raw_tfidf_vectorizer.transform([text]),
+        kb_index.tfidf_vectorizer
+    )
+
+def analyze_queries(texts: List[str], kb_index: KBIndex) -> List[QueryAnalysis]:
+    """analyze_query для пакета: векторизаторы вызываются один раз на весь пакет."""
+    terms = [_query_terms(text) for text in texts]
+    labeled_vecs = kb_index.tfidf_vectorizer.transform([lemmatized for _, _, lemmatized in terms])
+    raw_vecs = kb_index.raw_tfidf_vectorizer.transform(texts)
+    return [
+        QueryAnalysis(
+            text, question_lower, lemmas, dict.fromkeys(expand_with_synonyms(set(lemmas)), 1.0),
+            labeled_vecs[i], raw_vecs[i], kb_index.tfidf_vectorizer
+        )
+        for i, (text, (question_lower, lemmas, _)) in enumerate(zip(texts, terms))
+    ]
+
+def combine_turns(current: QueryAnalysis, previous: List[QueryAnalysis]) -> QueryAnalysis:
+    """Складывает текущую реплику с прошлыми (от старых к новым) с затухающими весами."""
+    parts = [(current, 1.0)] + [
+        (turn, CONTEXT_DECAY ** age) for age, turn in enumerate(reversed(previous), start=1)
+    ]
+    keyword_weights: Dict[str, float] = {}
+    for turn, weight in parts:
+        for word, word_weight in turn.keyword_weights.items():
+            keyword_weights[word] = max(keyword_weights.get(word, 0.0), word_weight * weight)
+    labeled_vec = sum(turn.labeled_vec * weight for turn, weight in parts)
+    raw_vec = sum(turn.raw_vec * weight for turn, weight in parts)
+    return QueryAnalysis(current.text, current.question_lower, current.lemmas, keyword_weights, labeled_vec, raw_vec,
+                         current.vectorizer, parts=parts)
+
+
+def confident_keywords(keyword_results: List[dict]) -> bool:
+    """Лучший ответ по ключевым словам уверен и без полнотекстового этапа."""
+    return CASCADE_EARLY_EXIT and bool(keyword_results) and keyword_results[0]["score"] * 0.6 > CONFIDENT_SCORE
+
+def cascade_search(query: QueryAnalysis, kb_index: KBIndex, deadline: float) -> Tuple[List[dict], List[dict]]:
+    """
+    Каскад: записи с общими леммами, ключевыми фразами или терминами TF-IDF (постинги) -> кандидаты
+    -> лучшие среди них по ключевым словам -> полнотекстовый косинус только для кандидатов.
+    Уверенный ответ по ключевым словам и исчерпанный бюджет времени пропускают полнотекстовый этап.
+    """
+    candidates = kb_index.cascade_candidates(query)
+    keyword_results = kb_index.keyword_search(query, top_k=5, candidates=candidates)
+    if confident_keywords(keyword_results):
+        return keyword_results, []
+    if time.monotonic() > deadline:
+        return keyword_results, []
+    return keyword_results, kb_index.fulltext_search(query, top_k=5, candidates=candidates)
+
+def search_knowledge_base(user_question: str, kb_index: KBIndex,
+                          context_turns: Optional[List[QueryAnalysis]] = None,
+                          analysis: Optional[QueryAnalysis] = None,
+                          feedback: Optional["FeedbackStats"] = None,
+                          deadline: Optional[float] = None) -> Tuple[Optional[str], float, List[dict]]:
+    """deadline — time.monotonic(), после которого новые этапы поиска не начинаются (по умолчанию — бюджет от старта)."""
+    if deadline is None:
+        deadline = time.monotonic() + SEARCH_TIME_BUDGET_SECONDS
+    if analysis is None:
+        canned = kb_index.exact_match(user_question)
+        if canned is not None:
+            return canned
+        analysis = analyze_query(preprocess_question(user_question), kb_index)
+    query = combine_turns(analysis, context_turns) if context_turns else analysis
+    
+    keyword_results, fulltext_results = cascade_search(query, kb_index, deadline)
+    
+    # Повтор по сырому тексту нужен, только если preprocess_question срезал вводные слова:
+    # иначе разбор сырого текста совпадёт с уже сделанным
+    if (not keyword_results and not fulltext_results and analysis.text != user_question.lower().strip()
+            and time.monotonic() < deadline):
+        raw_analysis = analyze_query(user_question, kb_index)
+        raw_query = combine_turns(raw_analysis, context_turns) if context_turns else raw_analysis
+        keyword_results, fulltext_results = cascade_search(raw_query, kb_index, deadline)
+    
+    return rank_search_results(keyword_results, fulltext_results, kb_index, feedback)
+
+def rank_search_results(keyword_results: List[dict], fulltext_results: List[dict], kb_index: KBIndex,
+                        feedback: Optional["FeedbackStats"] = None) -> Tuple[Optional[str], float, List[dict]]:
+    """Сводит оценки двух этапов (и оценки пользователей) в ответ, его балл и до трёх кандидатов."""
     combined_results = {}
     for res in keyword_results:
         combined_results.setdefault(res["index"], 0)
@@ -445,40 +1229,1185 @@ def search_knowledge_base(user_question: str, kb_index: KBIndex) -> Tuple[Option
         combined_results.setdefault(res["index"], 0)
         combined_results[res["index"]] += res["score"] * 50 * 0.4
     
+    # Оценки пользователей только переставляют уже найденные записи, новых не добавляют
+    if feedback is not None:
+        for idx in combined_results:
+            combined_results[idx] += feedback.prior(kb_index.items[idx].item_id)
+    
     if combined_results:
         sorted_results = sorted(combined_results.items(), key=lambda x: x[1], reverse=True)
-        candidates = []
-        for idx, score in sorted_results[:3]:
-            topic_name = kb_index.items[idx]["original_keywords"][0] if kb_index.items[idx]["original_keywords"] else "Тема"
-            candidates.append({
-                "index": idx, 
-                "score": score, 
-                "topic": topic_name, 
-                "context": kb_index.items[idx]["context"]
-            })
+        candidates = [kb_index.make_candidate(idx, score) for idx, score in sorted_results[:3]]
         
         best_idx, best_score = sorted_results[0]
-        if best_score > 3.5:
-            return kb_index.items[best_idx]["context"], best_score, candidates
+        if best_score > CONFIDENT_SCORE:
+            return kb_index.items[best_idx].context, best_score, candidates
         if best_score > 1.0:
-            return kb_index.items[best_idx]["context"], best_score, candidates
+            return kb_index.items[best_idx].context, best_score, candidates
     
     return None, 0.0, []
 
-def get_fuzzy_suggestion(question: str, kb_index: KBIndex) -> Optional[str]:
+def search_knowledge_base_batch(questions: List[str], kb_index: KBIndex,
+                                feedback: Optional["FeedbackStats"] = None) -> List[Tuple[Optional[str], float, List[dict]]]:
+    """
+    search_knowledge_base для пакета независимых вопросов (без контекста диалога и бюджета времени).
+    Разбор, оценка по ключевым словам и полнотекстовый этап — по одному матричному вызову на пакет;
+    ранний выход по уверенным ключевым словам и повтор по сырому тексту — как у одиночного поиска.
+    """
+    results: List[Optional[Tuple[Optional[str], float, List[dict]]]] = [None] * len(questions)
+    pending = []
+    for i, question in enumerate(questions):
+        canned = kb_index.exact_match(question)
+        if canned is not None:
+            results[i] = canned
+        else:
+            pending.append(i)
+    if not pending:
+        return results
+
+    analyses = analyze_queries([preprocess_question(questions[i]) for i in pending], kb_index)
+    keyword_batches = kb_index.keyword_search_batch(analyses, top_k=5)
+    uncertain = [pos for pos, keyword_results in enumerate(keyword_batches) if not confident_keywords(keyword_results)]
+    fulltext_batches: List[List[dict]] = [[] for _ in pending]
+    for pos, fulltext_results in zip(uncertain, kb_index.fulltext_search_batch([analyses[pos] for pos in uncertain], top_k=5)):
+        fulltext_batches[pos] = fulltext_results
+
+    for pos, i in enumerate(pending):
+        keyword_results, fulltext_results = keyword_batches[pos], fulltext_batches[pos]
+        if not keyword_results and not fulltext_results and analyses[pos].text != questions[i].lower().strip():
+            keyword_results, fulltext_results = cascade_search(analyze_query(questions[i], kb_index), kb_index, math.inf)
+        results[i] = rank_search_results(keyword_results, fulltext_results, kb_index, feedback)
+    return results
+
+def build_exact_match_index(kb_index: KBIndex) -> None:
+    """Таблица точных фраз и готовые ответы кнопок меню (через полный поиск, один раз)."""
+    kb_index.build_exact_phrases()
+    build_canned_answers(kb_index)
+
+def build_canned_answers(kb_index: KBIndex) -> None:
+    """Готовые ответы кнопок меню: MENU_QUERIES — несколько полных поисков."""
+    kb_index.canned_answers = {}
+    for menu_query in MENU_QUERIES.values():
+        analysis = analyze_query(preprocess_question(menu_query), kb_index)
+        kb_index.canned_answers[normalize_phrase(menu_query)] = search_knowledge_base(menu_query, kb_index, analysis=analysis)
+
+def get_fuzzy_suggestion(question_lower: str, kb_index: KBIndex) -> Optional[str]:
+    """question_lower — нормализованный текст из QueryAnalysis."""
     if not FUZZY_ENABLED or not kb_index.all_keywords_list:
         return None
-    best_match, score = process.extractOne(question, kb_index.all_keywords_list)
+    best_match, score = process.extractOne(question_lower, kb_index.all_keywords_list)
     if score > 70:
         return best_match
     return None
 
+# ============================================================
+# 🗄 ОБЩИЙ ИНДЕКС ДЛЯ НЕСКОЛЬКИХ ВОРКЕРОВ
+# ============================================================
+
+def _save_array(file_path: Path, array: np.ndarray) -> None:
+    # Новый файл под временным именем и os.replace: у воркеров, подключивших прежний индекс через mmap,
+    # остаётся старый inode. Запись поверх (np.save по тому же пути) обрезала бы файл под ними — SIGBUS
+    tmp_path = file_path.with_name(file_path.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_path, file_path)
+
+def _save_csr(directory: Path, name: str, matrix) -> None:
+    matrix = sp.csr_matrix(matrix)
+    _save_array(directory / f"{name}_data.npy", matrix.data)
+    _save_array(directory / f"{name}_indices.npy", matrix.indices)
+    _save_array(directory / f"{name}_indptr.npy", matrix.indptr)
+
+def _load_csr(directory: Path, name: str, shape: List[int]):
+    # mmap_mode='r': данные не копируются в память процесса, страницы общие для всех воркеров
+    data = np.load(directory / f"{name}_data.npy", mmap_mode='r')
+    indices = np.load(directory / f"{name}_indices.npy", mmap_mode='r')
+    indptr = np.load(directory / f"{name}_indptr.npy", mmap_mode='r')
+    return sp.csr_matrix((data, indices, indptr), shape=tuple(shape), copy=False)
+
+def _vocabulary_terms(vectorizer: TfidfVectorizer) -> List[str]:
+    terms = [""] * len(vectorizer.vocabulary_)
+    for term, col in vectorizer.vocabulary_.items():
+        terms[col] = term
+    return terms
+
+def _restore_vectorizer(vectorizer: TfidfVectorizer, terms: List[str], idf: np.ndarray) -> TfidfVectorizer:
+    vectorizer.vocabulary_ = {term: col for col, term in enumerate(terms)}
+    vectorizer.idf_ = np.asarray(idf)
+    return vectorizer
+
+def export_kb_index(kb_index: KBIndex, directory: str,
+                    source_version: Optional[Tuple[int, int, int]] = None) -> None:
+    """
+    Публикует готовый индекс в каталог (по умолчанию в /dev/shm).
+    Матрицы пишутся в .npy и подключаются воркерами через mmap только для чтения.
+    meta.json пишется последним — его наличие означает, что индекс готов.
+    source_version — версия файла базы, из которой построен индекс: по ней воркер видит,
+    что базу с тех пор правили, и перечитывает её.
+    """
+    path = Path(directory)
+    path.mkdir(parents=True, exist_ok=True)
+    meta_path = path / "meta.json"
+    if meta_path.exists():
+        meta_path.unlink()
+
+    _save_csr(path, "keywords", kb_index.keyword_matrix)
+    _save_csr(path, "labeled", kb_index.tfidf_labeled_matrix)
+    _save_csr(path, "raw", kb_index.tfidf_raw_matrix)
+    _save_csr(path, "keyword_postings", kb_index.keyword_postings)
+    _save_csr(path, "labeled_postings", kb_index.labeled_postings)
+    _save_csr(path, "raw_postings", kb_index.raw_postings)
+    _save_array(path / "labeled_idf.npy", kb_index.tfidf_vectorizer.idf_)
+    _save_array(path / "raw_idf.npy", kb_index.raw_tfidf_vectorizer.idf_)
+    # Тексты ответов — один UTF-8 блок и смещения: воркеры читают их через mmap, а не держат копию
+    encoded = [item.context.encode("utf-8") for item in kb_index.items]
+    _save_array(path / "contexts.npy", np.frombuffer(b"".join(encoded), dtype=np.uint8))
+    _save_array(path / "context_offsets.npy", np.cumsum([0] + [len(text) for text in encoded], dtype=np.int64))
+    del encoded
+
+    meta = {
+        "items": [{"original_keywords": item.original_keywords, "id": item.item_id} for item in kb_index.items],
+        "lemma_terms": kb_index.lemma_terms,
+        "keywords_shape": list(kb_index.keyword_matrix.shape),
+        "labeled_vocabulary": _vocabulary_terms(kb_index.tfidf_vectorizer),
+        "raw_vocabulary": _vocabulary_terms(kb_index.raw_tfidf_vectorizer),
+        "labeled_shape": list(kb_index.tfidf_labeled_matrix.shape),
+        "raw_shape": list(kb_index.tfidf_raw_matrix.shape),
+        "source_version": source_version,
+    }
+    tmp_path = path / "meta.json.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp_path, meta_path)
+
+def attach_kb_index(directory: str) -> KBIndex:
+    """Подключает индекс, опубликованный export_kb_index, без лемматизации и обучения TF-IDF."""
+    path = Path(directory)
+    meta_path = path / "meta.json"
+    if not meta_path.exists():
+        raise FileNotFoundError(f"Общий индекс не найден: {directory}")
+    with open(meta_path, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+
+    offsets = np.load(path / "context_offsets.npy").tolist()
+    # mmap пустого массива невозможен — база без текстов читается обычным способом
+    contexts = np.load(path / "contexts.npy", mmap_mode='r' if offsets[-1] else None)
+    kb_index = KBIndex()
+    kb_index.items = [
+        SharedKBItem(contexts, offsets[i], offsets[i + 1], item["original_keywords"], item["id"])
+        for i, item in enumerate(meta["items"])
+    ]
+    kb_index.lemma_terms = meta["lemma_terms"]
+    kb_index.lemma_ids = {lemma: lemma_id for lemma_id, lemma in enumerate(kb_index.lemma_terms)}
+    kb_index.keyword_matrix = _load_csr(path, "keywords", meta["keywords_shape"])
+    kb_index.tfidf_vectorizer = _restore_vectorizer(
+        make_labeled_vectorizer(), meta["labeled_vocabulary"], np.load(path / "labeled_idf.npy")
+    )
+    kb_index.raw_tfidf_vectorizer = _restore_vectorizer(
+        make_raw_vectorizer(), meta["raw_vocabulary"], np.load(path / "raw_idf.npy")
+    )
+    kb_index.tfidf_labeled_matrix = _load_csr(path, "labeled", meta["labeled_shape"])
+    kb_index.tfidf_raw_matrix = _load_csr(path, "raw", meta["raw_shape"])
+    kb_index.keyword_postings = _load_csr(path, "keyword_postings", meta["keywords_shape"][::-1])
+    kb_index.labeled_postings = _load_csr(path, "labeled_postings", meta["labeled_shape"][::-1])
+    kb_index.raw_postings = _load_csr(path, "raw_postings", meta["raw_shape"][::-1])
+    kb_index.source_version = tuple(meta["source_version"]) if meta.get("source_version") else None
+    kb_index.build_phrase_index()
+    kb_index.build_keywords_list()
+    build_exact_match_index(kb_index)
+    # Кэш лемм не публикуется: воркеры супервизора наследуют его через fork, остальные заполняют по запросам
+    return kb_index
+
+# ============================================================
+# ✏️ ПРАВКИ БАЗЫ ЗНАНИЙ
+# ============================================================
+
+def _replace_row(matrix, idx: int, row, n_cols: int):
+    """
+    Матрица со строкой idx, заменённой на row (idx == числу строк — добавление в конец).
+    Массивы CSR склеиваются напрямую: одно копирование вместо срезов и vstack.
+    """
+    row = sp.csr_matrix(row)
+    row.sort_indices()
+    n_rows = matrix.shape[0]
+    indptr = matrix.indptr
+    start = indptr[idx]
+    end = indptr[idx + 1] if idx < n_rows else start
+    delta = len(row.data) - (end - start)
+    index_dtype = np.promote_types(matrix.indices.dtype, indptr.dtype)
+    data = np.concatenate([matrix.data[:start], row.data.astype(matrix.data.dtype, copy=False), matrix.data[end:]])
+    indices = np.concatenate([matrix.indices[:start], row.indices, matrix.indices[end:]]).astype(index_dtype, copy=False)
+    if idx < n_rows:
+        new_indptr = np.concatenate([indptr[:idx + 1], indptr[idx + 1:] + delta])
+    else:
+        new_indptr = np.concatenate([indptr, [indptr[-1] + len(row.data)]])
+        n_rows += 1
+    return sp.csr_matrix((data, indices, new_indptr.astype(index_dtype, copy=False)), shape=(n_rows, n_cols))
+
+def _row_terms(matrix, idx: int) -> np.ndarray:
+    return np.asarray(matrix.indices[matrix.indptr[idx]:matrix.indptr[idx + 1]])
+
+def _replace_posting(postings, idx: int, old_terms: np.ndarray, row, n_items: int):
+    """
+    Постинги после того, как строка idx исходной матрицы (термины old_terms) заменена на row.
+    Меняются только строки постингов терминов старой и новой строки: idx удаляется из одних
+    и вставляется на своё место по порядку в другие. Массивы копируются одним проходом
+    по кускам между этими местами — без транспонирования всей матрицы.
+    """
+    row = sp.csr_matrix(row)
+    row.sort_indices()
+    n_terms = row.shape[1]
+    # Словарь лемм мог вырасти — новые термины получают пустые строки постингов
+    indptr = np.concatenate([postings.indptr, np.full(n_terms - postings.shape[0], postings.indptr[-1])])
+    indices, data = postings.indices, postings.data
+
+    def slot(term: int) -> int:
+        return int(indptr[term] + np.searchsorted(indices[indptr[term]:indptr[term + 1]], idx))
+
+    # (позиция в старых массивах, 0 — вставить перед ней значение, 1 — пропустить её, термин, значение);
+    # на одной позиции вставки идут раньше пропуска и по порядку терминов
+    edits = sorted([(slot(term), 0, term, value) for term, value in zip(row.indices, row.data)]
+                   + [(slot(term), 1, term, 0) for term in old_terms])
+    new_indices = np.empty(len(indices) + len(row.indices) - len(old_terms), dtype=indices.dtype)
+    new_data = np.empty(len(new_indices), dtype=data.dtype)
+    src = dst = 0
+    for pos, skip, _, value in edits:
+        length = pos - src
+        new_indices[dst:dst + length] = indices[src:pos]
+        new_data[dst:dst + length] = data[src:pos]
+        dst += length
+        if skip:
+            src = pos + 1
+        else:
+            new_indices[dst] = idx
+            new_data[dst] = value
+            dst += 1
+            src = pos
+    new_indices[dst:] = indices[src:]
+    new_data[dst:] = data[src:]
+
+    delta = np.zeros(n_terms, dtype=np.int64)
+    delta[old_terms] -= 1
+    delta[row.indices] += 1
+    new_indptr = indptr.astype(np.int64, copy=True)
+    new_indptr[1:] += np.cumsum(delta)
+    return sp.csr_matrix(
+        (new_data, new_indices, new_indptr.astype(indices.dtype, copy=False)), shape=(n_terms, n_items)
+    )
+
+def update_kb_entry(old_index: KBIndex, idx: Optional[int], keywords: List[str], context: str) -> Tuple[KBIndex, int]:
+    """
+    Новая версия индекса с одной изменённой записью: idx=None — добавить, пустой context — удалить.
+    Лемматизируется и векторизуется только эта запись; TF-IDF строится старыми векторизаторами
+    (transform), поэтому словарь и IDF не меняются до фонового переобучения.
+    Старая версия не трогается — поиски, которые уже идут в потоках, доработают на ней.
+    """
+    kb_index = old_index.copy()
+    if idx is None:
+        idx = len(kb_index.items)
+        old_keyword_terms = old_labeled_terms = old_raw_terms = np.empty(0, dtype=np.int64)
+        old_keywords = ()
+        item = KBItem(context, keywords)
+        kb_index.items.append(item)
+    else:
+        old_keywords = kb_index.items[idx].original_keywords
+        old_keyword_terms = _row_terms(old_index.keyword_matrix, idx)
+        old_labeled_terms = _row_terms(old_index.tfidf_labeled_matrix, idx)
+        old_raw_terms = _row_terms(old_index.tfidf_raw_matrix, idx)
+        item = KBItem(context, keywords if context else [], kb_index.items[idx].item_id)
+        kb_index.items[idx] = item
+
+    lemma_ids = sorted(kb_index.intern_lemma(lemma) for lemma in keyword_lemmas(item.original_keywords))
+    n_lemmas = len(kb_index.lemma_terms)
+    keyword_row = sp.csr_matrix(
+        (np.ones(len(lemma_ids), dtype=np.uint8), np.array(lemma_ids, dtype=np.int32), np.array([0, len(lemma_ids)])),
+        shape=(1, n_lemmas)
+    )
+    kb_index.keyword_matrix = _replace_row(kb_index.keyword_matrix, idx, keyword_row, n_lemmas)
+
+    phrase_bonuses = {kb_index.intern_phrase(phrase): bonus for phrase, bonus in keyword_phrases(item.original_keywords).items()}
+    phrase_ids = sorted(phrase_bonuses)
+    n_phrases = len(kb_index.phrase_terms)
+    phrase_row = sp.csr_matrix(
+        (np.array([phrase_bonuses[i] for i in phrase_ids], dtype=np.float32), np.array(phrase_ids, dtype=np.int32),
+         np.array([0, len(phrase_ids)])),
+        shape=(1, n_phrases)
+    )
+    kb_index.phrase_matrix = _replace_row(kb_index.phrase_matrix, idx, phrase_row, n_phrases)
+
+    labeled_row = kb_index.tfidf_vectorizer.transform([lemmatize_sentence(context)])
+    raw_row = kb_index.raw_tfidf_vectorizer.transform([context])
+    kb_index.tfidf_labeled_matrix = _replace_row(kb_index.tfidf_labeled_matrix, idx, labeled_row, labeled_row.shape[1])
+    kb_index.tfidf_raw_matrix = _replace_row(kb_index.tfidf_raw_matrix, idx, raw_row, raw_row.shape[1])
+    n_items = len(kb_index.items)
+    kb_index.keyword_postings = _replace_posting(kb_index.keyword_postings, idx, old_keyword_terms, keyword_row, n_items)
+    kb_index.labeled_postings = _replace_posting(kb_index.labeled_postings, idx, old_labeled_terms, labeled_row, n_items)
+    kb_index.raw_postings = _replace_posting(kb_index.raw_postings, idx, old_raw_terms, raw_row, n_items)
+
+    kb_index.stale_edits += 1
+    # Списки ключей и точных фраз меняются только у этой записи; ответы кнопок меню — три поиска
+    kb_index.update_keywords_list(old_keywords, item.original_keywords)
+    kb_index.update_exact_phrases(idx)
+    build_canned_answers(kb_index)
+    return kb_index, idx
+
+def refit_kb_index(old_index: KBIndex) -> KBIndex:
+    """Переобучает TF-IDF на текущих текстах (новые слова в словаре, свежий IDF). Ключевые слова не трогаются."""
+    kb_index = old_index.copy()
+    kb_index.build_tfidf_index([item.context for item in kb_index.items])
+    kb_index.build_postings()
+    kb_index.stale_edits = 0
+    # Ключевые слова не менялись — точные фразы остаются, ответы кнопок меню ищутся по новому TF-IDF
+    build_canned_answers(kb_index)
+    return kb_index
+
+def save_knowledge_base(kb_index: KBIndex, file_path: str) -> None:
+    """
+    Пишет базу в формате файла (.json или .jsonl); id сохраняются, чтобы оценки ответов пережили правку текста.
+    Удалённые записи остаются пустыми ("context": ""): номера записей одинаковы у всех воркеров,
+    которые перечитывают файл, и после перезапуска.
+    """
+    entries = (
+        {"id": item.item_id, "context": item.context, "keywords": list(item.original_keywords)}
+        for item in kb_index.items
+    )
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        if file_path.endswith(".jsonl"):
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        else:
+            json.dump(list(entries), f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, file_path)
+
+
+class KBEditor:
+    """
+    Правки базы из админ-команд. Индекс заменяется целиком (copy-on-write): обработчики берут
+    глобальный kb_index в начале поиска и не видят полуизменённого состояния.
+    Правки и фоновое переобучение идут по одной, под общим замком.
+    Файл базы общий для воркеров: правка идёт под file_lock и начинается с перечитывания файла,
+    если его изменил другой воркер, — иначе воркеры затирали бы записи друг друга и выдавали
+    один и тот же номер. Чужие правки воркер подхватывает и сам, раз в KB_SYNC_INTERVAL_SECONDS
+    и при старте (перезапущенный воркер подключает индекс, опубликованный до правок).
+    version — версия файла, из которой построен kb_index; None — индекс не из этого файла
+    (нагрузочный тест, бенчмарк), тогда файл не перечитывается.
+    """
+
+    def __init__(self, file_path: str = KB_FILE, refit_interval: float = KB_REFIT_INTERVAL_SECONDS,
+                 sync_interval: float = KB_SYNC_INTERVAL_SECONDS):
+        self.file_path = file_path
+        self.refit_interval = refit_interval
+        self.sync_interval = sync_interval
+        self.version: Optional[Tuple[int, int, int]] = None
+        self.lock: Optional[asyncio.Lock] = None
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self, application: Application) -> None:
+        self.lock = asyncio.Lock()
+        await self.sync()
+        self.task = asyncio.create_task(self._refit_loop())
+
+    async def stop(self, application: Application) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    def _reload_if_changed(self, base: KBIndex) -> KBIndex:
+        """Индекс по текущему файлу: base, если файл не менялся с нашей последней записи или чтения."""
+        if self.version is None:
+            return base
+        version = file_version(self.file_path)
+        if version == self.version:
+            return base
+        reloaded = preprocess_knowledge_base(iter_knowledge_base(self.file_path))
+        self.version = version
+        logger.info(f"Knowledge base changed by another worker, reloaded: {len(reloaded.items)} записей")
+        return reloaded
+
+    def _apply_locked(self, base: KBIndex, idx: Optional[int], keywords: List[str],
+                      context: str) -> Tuple[KBIndex, Optional[int]]:
+        with file_lock(self.file_path):
+            base = self._reload_if_changed(base)
+            if idx is not None and not base.is_valid_index(idx):
+                return base, None
+            new_index, idx = update_kb_entry(base, idx, keywords, context)
+            save_knowledge_base(new_index, self.file_path)
+            if self.version is not None:
+                self.version = file_version(self.file_path)
+        return new_index, idx
+
+    async def apply(self, idx: Optional[int], keywords: List[str], context: str) -> Optional[int]:
+        """Номер изменённой записи; None — запись idx уже удалена (другим воркером)."""
+        global kb_index
+        async with self.lock:
+            kb_index, idx = await run_blocking(self._apply_locked, kb_index, idx, keywords, context)
+        return idx
+
+    async def sync(self) -> None:
+        global kb_index
+        async with self.lock:
+            kb_index = await run_blocking(self._reload_if_changed, kb_index)
+
+    async def refit(self) -> None:
+        global kb_index
+        async with self.lock:
+            if not kb_index.stale_edits:
+                return
+            started = time.perf_counter()
+            kb_index = await run_blocking(refit_kb_index, kb_index)
+            logger.info(f"TF-IDF refitted in {time.perf_counter() - started:.2f}s")
+
+    async def _refit_loop(self) -> None:
+        last_refit = time.monotonic()
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await self.sync()
+                if time.monotonic() - last_refit >= self.refit_interval:
+                    last_refit = time.monotonic()
+                    await self.refit()
+            except Exception:
+                logger.exception("Background knowledge base sync or TF-IDF refit failed")
+
+# ============================================================
+# ❓ НЕИЗВЕСТНЫЕ ВОПРОСЫ
+# ============================================================
+
+_MINHASH_PRIME = (1 << 61) - 1
+_MINHASH_RANDOM = random.Random(20240601)
+_MINHASH_PARAMS = [
+    (_MINHASH_RANDOM.randrange(1, _MINHASH_PRIME), _MINHASH_RANDOM.randrange(0, _MINHASH_PRIME))
+    for _ in range(UNKNOWN_MINHASH_PERMUTATIONS)
+]
+
+def minhash_signature(lemmas: frozenset) -> Tuple[int, ...]:
+    # crc32, а не hash(): сигнатуры должны совпадать между перезапусками
+    hashes = [zlib.crc32(lemma.encode("utf-8")) for lemma in lemmas]
+    return tuple(min((a * h + b) % _MINHASH_PRIME for h in hashes) for a, b in _MINHASH_PARAMS)
+
+
+class UnknownQuestionStore:
+    """
+    Неизвестные вопросы без дублей: повтор или почти-повтор (по набору лемм) увеличивает
+    count и last_seen существующей записи. Размер файла растёт с числом разных вопросов, а не с трафиком.
+    Точные повторы находятся по сигнатуре из отсортированных лемм, близкие — через MinHash LSH
+    с проверкой коэффициента Жаккара.
+    Файл общий для воркеров супервизора: запись идёт под file_lock и начинается с перечитывания файла,
+    если его изменил другой процесс, — иначе каждый воркер затирал бы чужие вопросы своей копией.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.records: Optional[List[dict]] = None
+        self.version: Optional[Tuple[int, int, int]] = None
+        self.signatures: Dict[str, int] = {}
+        self.lemma_sets: List[frozenset] = []
+        self.buckets: Dict[Tuple[int, Tuple[int, ...]], List[int]] = {}
+        # Разбор вопроса (ключ, леммы, полосы LSH) переживает перечитывание файла. Кэш ограничен:
+        # иначе каждый новый вариант спама оставался бы в памяти навсегда, даже свёрнутый в дубль
+        self.analyzed: "OrderedDict[str, Tuple[str, frozenset, List[Tuple[int, Tuple[int, ...]]]]]" = OrderedDict()
+
+    @staticmethod
+    def question_lemmas(question: str) -> frozenset:
+        return frozenset(extract_keywords(question, use_synonyms=False))
+
+    def _sync(self) -> None:
+        """Перечитывает файл, если он изменился с последнего чтения или записи этим процессом."""
+        version = file_version(self.file_path)
+        if self.records is not None and version == self.version:
+            return
+        self._reset()
+        # Старый файл (по записи на сообщение) сворачивается при чтении и сжимается при следующей записи
+        for record in load_json(self.file_path):
+            self._fold(record)
+        self.version = version
+
+    def _reset(self) -> None:
+        self.records = []
+        self.signatures = {}
+        self.lemma_sets = []
+        self.buckets = {}
+
+    def _bands(self, lemmas: frozenset) -> List[Tuple[int, Tuple[int, ...]]]:
+        signature = minhash_signature(lemmas)
+        rows = len(signature) // UNKNOWN_LSH_BANDS
+        return [(band, signature[band * rows:(band + 1) * rows]) for band in range(UNKNOWN_LSH_BANDS)]
+
+    def _analyze(self, question: str) -> Tuple[str, frozenset, List[Tuple[int, Tuple[int, ...]]]]:
+        analyzed = self.analyzed.get(question)
+        if analyzed is not None:
+            self.analyzed.move_to_end(question)
+            return analyzed
+        lemmas = self.question_lemmas(question)
+        key = " ".join(sorted(lemmas)) if lemmas else "raw:" + normalize_phrase(question)
+        analyzed = self.analyzed[question] = (key, lemmas, self._bands(lemmas) if lemmas else [])
+        if len(self.analyzed) > UNKNOWN_ANALYZED_CACHE_SIZE:
+            self.analyzed.popitem(last=False)
+        return analyzed
+
+    def _find_duplicate(self, key: str, lemmas: frozenset, bands: List[Tuple[int, Tuple[int, ...]]]) -> Optional[int]:
+        idx = self.signatures.get(key)
+        if idx is not None or not lemmas:
+            return idx
+        best_idx, best_similarity = None, UNKNOWN_DUPLICATE_JACCARD
+        for band in bands:
+            for candidate in self.buckets.get(band, ()):
+                other = self.lemma_sets[candidate]
+                similarity = len(lemmas & other) / len(lemmas | other)
+                if similarity >= best_similarity:
+                    best_idx, best_similarity = candidate, similarity
+        return best_idx
+
+    def _fold(self, record: dict) -> dict:
+        key, lemmas, bands = self._analyze(record.get("question", ""))
+        idx = self._find_duplicate(key, lemmas, bands)
+        if idx is not None:
+            target = self.records[idx]
+            target["count"] = target.get("count", 1) + record.get("count", 1)
+            last_seen = record.get("last_seen", record.get("timestamp", ""))
+            if last_seen >= target.get("last_seen", ""):
+                target["last_seen"] = last_seen
+                target["user_id"] = record.get("user_id")
+            self.signatures.setdefault(key, idx)
+            return target
+
+        record.setdefault("count", 1)
+        record.setdefault("last_seen", record.get("timestamp", ""))
+        idx = len(self.records)
+        self.records.append(record)
+        self.lemma_sets.append(lemmas)
+        self.signatures[key] = idx
+        for band in bands:
+            self.buckets.setdefault(band, []).append(idx)
+        return record
+
+    def add(self, question: str, user_id: int) -> dict:
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with file_lock(self.file_path):
+            self._sync()
+            record = self._fold({"question": question, "user_id": user_id, "timestamp": now, "count": 1, "last_seen": now})
+            save_json(self.file_path, self.records)
+            self.version = file_version(self.file_path)
+        return record
+
+    def all(self) -> List[dict]:
+        self._sync()
+        return self.records
+
+    def clear(self) -> None:
+        with file_lock(self.file_path):
+            save_json(self.file_path, [])
+            self._reset()
+            self.analyzed.clear()
+            self.version = file_version(self.file_path)
+
+class FeedbackStats:
+    """
+    Счётчики 👍/👎 по item_id, обновляются на каждой оценке. Поиск и админка читают только их;
+    feedback.json остаётся журналом событий и нужен лишь один раз — чтобы посчитать счётчики,
+    если файла с ними ещё нет.
+    Файл общий для воркеров супервизора: оценка записывается под file_lock поверх свежей версии файла,
+    а поиск раз в FEEDBACK_STATS_REFRESH_SECONDS подхватывает оценки других воркеров.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.stats: Optional[Dict[str, dict]] = None
+        self.version: Optional[Tuple[int, int, int]] = None
+        self.checked_at = 0.0
+        # prior() вызывается из потоков поиска, record() — из event loop
+        self.lock = threading.Lock()
+
+    def _sync(self, kb_index: Optional[KBIndex] = None) -> None:
+        """Перечитывает файл, если он изменился с последнего чтения или записи этим процессом."""
+        version = file_version(self.file_path)
+        if self.stats is not None and version == self.version:
+            return
+        if version is not None:
+            self.stats = {record["id"]: record for record in load_json(self.file_path)}
+        else:
+            self.stats = {}
+            if kb_index is not None:
+                self._rebuild_from_log(kb_index)
+        self.version = file_version(self.file_path)
+        self.checked_at = time.monotonic()
+
+    def _rebuild_from_log(self, kb_index: KBIndex) -> None:
+        # В журнале нет индексов записей — только первые 200 символов ответа
+        by_prefix = {item.context[:200]: item for item in kb_index.items}
+        for event in load_json(FEEDBACK_FILE):
+            item = by_prefix.get(event.get("answer", ""))
+            if item is not None and event.get("type") in ("like", "dislike"):
+                self._count(item, event["type"], event.get("time", ""))
+        if self.stats:
+            save_json(self.file_path, list(self.stats.values()))
+
+    def _count(self, item: KBItem, fb_type: str, timestamp: str) -> dict:
+        record = self.stats.setdefault(item.item_id, {"id": item.item_id, "like": 0, "dislike": 0})
+        record[fb_type] += 1
+        record["topic"] = item.original_keywords[0] if item.original_keywords else "Тема"
+        record["last"] = timestamp
+        return record
+
+    def record(self, item: KBItem, fb_type: str, kb_index: KBIndex) -> dict:
+        with file_lock(self.file_path), self.lock:
+            self._sync(kb_index)
+            record = self._count(item, fb_type, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            save_json(self.file_path, list(self.stats.values()))
+            self.version = file_version(self.file_path)
+        return record
+
+    def prior(self, item_id: str) -> float:
+        if self.stats is None or not FEEDBACK_PRIOR_WEIGHT:
+            return 0.0
+        if time.monotonic() - self.checked_at > FEEDBACK_STATS_REFRESH_SECONDS:
+            with self.lock:
+                self._sync()
+                self.checked_at = time.monotonic()
+        record = self.stats.get(item_id)
+        if record is None:
+            return 0.0
+        votes = record["like"] + record["dislike"]
+        return FEEDBACK_PRIOR_WEIGHT * (record["like"] - record["dislike"]) / (votes + FEEDBACK_PRIOR_SMOOTHING)
+
+    def ranking(self, kb_index: KBIndex) -> List[dict]:
+        """Записи с оценками, худшие сверху: больше дизлайков, меньше лайков."""
+        with self.lock:
+            self._sync(kb_index)
+            return sorted(self.stats.values(), key=lambda r: (r["like"] - r["dislike"], -r["dislike"]))
+
+    def load(self, kb_index: KBIndex) -> None:
+        with file_lock(self.file_path), self.lock:
+            self._sync(kb_index)
+
+    def clear(self) -> None:
+        with file_lock(self.file_path), self.lock:
+            save_json(self.file_path, [])
+            self.stats = {}
+            self.version = file_version(self.file_path)
+
+# ============================================================
+# 📤 ИСХОДЯЩИЕ ЗАПРОСЫ К BOT API
+# ============================================================
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, запас не больше capacity."""
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, tokens: float = 1.0) -> float:
+        """Сколько секунд ждать, пока наберётся tokens. Токены не списываются."""
+        self._refill()
+        if self.tokens >= tokens:
+            return 0.0
+        return (tokens - self.tokens) / self.rate
+
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        self._refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    def reserve(self, tokens: float = 1.0) -> float:
+        """Списывает tokens сразу (запас может уйти в минус) и возвращает, сколько ждать своей очереди."""
+        self._refill()
+        self.tokens -= tokens
+        return max(0.0, -self.tokens / self.rate)
+
+
+class FloodControl:
+    """
+    Лимиты входящих обновлений: корзина на пользователя и общая.
+    admit() отвечает "ok", "warn" (первое превышение подряд — пользователю отправляется предупреждение)
+    или "drop". При общей перегрузке обновления отбрасываются молча: ответы тоже стоят лимита Bot API.
+    Администратор не ограничивается.
+    """
+
+    def __init__(self, user_rate: float = FLOOD_USER_RATE, user_burst: float = FLOOD_USER_BURST,
+                 global_rate: float = FLOOD_GLOBAL_RATE, global_burst: float = FLOOD_GLOBAL_BURST):
+        self.enabled = True
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.user_buckets: Dict[int, TokenBucket] = {}
+        self.warned: Set[int] = set()
+        self.shed: Counter = Counter()
+
+    def _user_bucket(self, user_id: int) -> TokenBucket:
+        bucket = self.user_buckets.get(user_id)
+        if bucket is None:
+            if len(self.user_buckets) > FLOOD_MAX_USER_BUCKETS:
+                self.user_buckets = {
+                    uid: b for uid, b in self.user_buckets.items() if b.delay(b.capacity) > 0
+                }
+                self.warned &= self.user_buckets.keys()
+            bucket = TokenBucket(self.user_rate, self.user_burst)
+            self.user_buckets[user_id] = bucket
+        return bucket
+
+    def admit(self, user_id: int, kind: str) -> str:
+        if not self.enabled or user_id == ADMIN_USER_ID:
+            return "ok"
+        if not self._user_bucket(user_id).try_acquire():
+            self.shed[kind] += 1
+            if user_id in self.warned:
+                return "drop"
+            self.warned.add(user_id)
+            return "warn"
+        if not self.global_bucket.try_acquire():
+            self.shed[kind] += 1
+            return "drop"
+        self.warned.discard(user_id)
+        return "ok"
+
+    def shed_total(self) -> int:
+        return sum(self.shed.values())
+
+
+class BotSender:
+    """
+    Пул отправки запросов к Bot API.
+    Запросы идут через несколько воркеров, с общим лимитом и лимитом на чат.
+    Лимит чата воркер не ждёт: запрос, которому рано, откладывается таймером до своего времени,
+    а воркеры тем временем отправляют сообщения в другие чаты. Порядок внутри чата сохраняется —
+    время отправки резервируется в порядке постановки. Воркер ждёт только общий лимит.
+    RetryAfter, таймауты и сетевые сбои повторяются с паузой.
+    Droppable-запросы (статус "печатает") не ждут лимита: если лимит исчерпан, они отбрасываются.
+    chat_id=None — запрос не сообщение в чат (answerCallbackQuery): он идёт только под общий лимит,
+    чтобы ответ на кнопку не съедал лимит чата у следующей за ним правки сообщения.
+    Через пул идут все запросы обработчиков; напрямую Bot API вызывает только сама библиотека (getUpdates).
+    """
+
+    def __init__(self, workers: int = OUTBOUND_WORKERS, queue_size: int = OUTBOUND_QUEUE_SIZE,
+                 global_rate: float = OUTBOUND_GLOBAL_RATE, per_chat_rate: float = OUTBOUND_PER_CHAT_RATE):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.per_chat_rate = per_chat_rate
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        # Запросы, которые можно отправлять сейчас; отложенные попадают сюда по таймеру
+        self.queue: Optional[asyncio.Queue] = None
+        # Всего запросов в пуле — и готовых, и отложенных; больше queue_size не принимается
+        self.pending = 0
+        self.has_space: Optional[asyncio.Event] = None
+        self.idle: Optional[asyncio.Event] = None
+        self.tasks: List[asyncio.Task] = []
+
+    async def start(self, application: Application) -> None:
+        self.queue = asyncio.Queue()
+        self.has_space = asyncio.Event()
+        self.has_space.set()
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, application: Application) -> None:
+        if self.queue is not None:
+            try:
+                await asyncio.wait_for(self.idle.wait(), timeout=OUTBOUND_DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning(f"Outbound queue not drained: {self.pending} requests dropped")
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > OUTBOUND_MAX_CHAT_BUCKETS:
+                # Полные корзины ничего не ограничивают — их можно выбросить
+                self.chat_buckets = {
+                    cid: b for cid, b in self.chat_buckets.items() if b.delay(b.capacity) > 0
+                }
+            bucket = TokenBucket(self.per_chat_rate, OUTBOUND_PER_CHAT_BURST)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _enqueue(self, request: tuple) -> None:
+        chat_id, droppable = request[0], request[4]
+        self.pending += 1
+        self.idle.clear()
+        if self.pending >= self.queue_size:
+            self.has_space.clear()
+        # Резервирование в порядке постановки сохраняет порядок сообщений внутри чата
+        wait = self._chat_bucket(chat_id).reserve() if chat_id is not None and not droppable else 0.0
+        if wait > 0:
+            asyncio.get_running_loop().call_later(wait, self.queue.put_nowait, request)
+        else:
+            self.queue.put_nowait(request)
+
+    def _done(self) -> None:
+        self.pending -= 1
+        self.has_space.set()
+        if not self.pending:
+            self.idle.set()
+
+    def submit(self, chat_id: Optional[int], func, /, *args, droppable: bool = False, **kwargs) -> Optional[asyncio.Future]:
+        """Ставит запрос в очередь без ожидания. Если очередь переполнена, запрос отбрасывается."""
+        if self.queue is None:
+            logger.warning("BotSender is not started, request dropped")
+            return None
+        if self.pending >= self.queue_size:
+            logger.warning(f"Outbound queue is full, request to {chat_id} dropped")
+            return None
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue((chat_id, func, args, kwargs, droppable, future))
+        # Результат fire-and-forget запроса могут не ждать: ошибку уже залогировал воркер
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        return future
+
+    async def call(self, chat_id: Optional[int], func, /, *args, **kwargs) -> Any:
+        """Ставит запрос в очередь (ждёт места, если очередь полна) и возвращает результат."""
+        if self.queue is None:
+            return await func(*args, **kwargs)
+        while self.pending >= self.queue_size:
+            await self.has_space.wait()
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue((chat_id, func, args, kwargs, False, future))
+        return await future
+
+    async def _acquire(self, droppable: bool) -> bool:
+        if droppable:
+            return self.global_bucket.try_acquire()
+        wait = self.global_bucket.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return True
+
+    async def _execute(self, func, args: tuple, kwargs: dict) -> Any:
+        delay = OUTBOUND_RETRY_BASE_DELAY
+        for attempt in range(OUTBOUND_MAX_RETRIES + 1):
+            try:
+                return await func(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == OUTBOUND_MAX_RETRIES:
+                    raise
+                logger.warning(f"Bot API flood control, retry after {e.retry_after}s")
+                await asyncio.sleep(float(e.retry_after))
+            except BadRequest:
+                # BadRequest — наследник NetworkError, но повтор его не исправит
+                raise
+            except (TimedOut, NetworkError) as e:
+                if attempt == OUTBOUND_MAX_RETRIES:
+                    raise
+                logger.warning(f"Bot API request failed ({e}), retry {attempt + 1}/{OUTBOUND_MAX_RETRIES}")
+                await asyncio.sleep(delay)
+                delay *= 2
+
+    async def _worker(self) -> None:
+        while True:
+            chat_id, func, args, kwargs, droppable, future = await self.queue.get()
+            try:
+                if not await self._acquire(droppable):
+                    if not future.done():
+                        future.set_result(None)
+                    continue
+                result = await self._execute(func, args, kwargs)
+                if not future.done():
+                    future.set_result(result)
+            except asyncio.CancelledError:
+                if not future.done():
+                    future.cancel()
+                raise
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                logger.error(f"Bot API request to {chat_id} failed: {e}")
+            finally:
+                self._done()
+
+class AdminNotifier:
+    """
+    Копит события для администратора и раз в окно отправляет одну сводку:
+    сколько событий каждого типа и самые частые из них.
+    Срочные события уходят сразу, без ожидания окна.
+    """
+
+    KIND_TITLES = {
+        "consult": "🔔 Новые заявки",
+        "dislike": "👎 Дизлайки",
+    }
+
+    def __init__(self, sender: BotSender, window: float = ADMIN_DIGEST_WINDOW_SECONDS,
+                 top_items: int = ADMIN_DIGEST_TOP_ITEMS):
+        self.sender = sender
+        self.window = window
+        self.top_items = top_items
+        self.pending: Dict[str, Counter] = {}
+        self.bot = None
+        self.flush_task: Optional[asyncio.Task] = None
+
+    def notify(self, bot, kind: str, item: str, urgent_text: Optional[str] = None) -> None:
+        """item — короткая строка для сводки; urgent_text — если задан, отправляется сразу."""
+        if urgent_text is not None:
+            self.sender.submit(ADMIN_USER_ID, bot.send_message, ADMIN_USER_ID, urgent_text, parse_mode="HTML")
+            return
+        self.bot = bot
+        self.pending.setdefault(kind, Counter())[item] += 1
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.window)
+        self.flush_task = None
+        self.flush()
+
+    def build_digest(self) -> str:
+        lines = [f"📬 <b>Сводка за {int(self.window)} с</b>"]
+        for kind, counter in self.pending.items():
+            lines.append(f"\n<b>{self.KIND_TITLES.get(kind, kind)}: {sum(counter.values())}</b>")
+            for item, count in counter.most_common(self.top_items):
+                prefix = f"×{count} " if count > 1 else ""
+                lines.append(f"• {prefix}{html.escape(item)}")
+            rest = len(counter) - self.top_items
+            if rest > 0:
+                lines.append(f"<i>…и ещё {rest}</i>")
+        return "\n".join(lines)
+
+    def flush(self) -> None:
+        if not self.pending or self.bot is None:
+            return
+        text = self.build_digest()
+        self.pending = {}
+        self.sender.submit(ADMIN_USER_ID, self.bot.send_message, ADMIN_USER_ID, text, parse_mode="HTML")
+
+    async def stop(self, application: Application) -> None:
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        self.flush()
+
+# ============================================================
+# 🔬 ПРОФИЛИРОВАНИЕ
+# ============================================================
+
+class UpdateProfiler:
+    """
+    cProfile на следующие N обновлений или T секунд (что наступит раньше).
+    Профилируется поток event loop и вызовы, вынесенные в потоки через run_blocking.
+    До Python 3.12 cProfile видит только свой поток, и вызовы в потоках профилируются отдельно.
+    С 3.12 cProfile работает через общий для процесса sys.monitoring: один профиль видит все потоки,
+    а второй, включённый в потоке, падает с "Another profiling tool is already active".
+    Пока профилирование выключено, цена — одна проверка флага на обновление.
+    """
+
+    PER_THREAD = sys.version_info < (3, 12)
+
+    def __init__(self):
+        self.active = False
+        self.lock = threading.Lock()
+        self.main_profile: Optional[cProfile.Profile] = None
+        self.thread_profiles: List[cProfile.Profile] = []
+        self.max_updates = 0
+        self.seen_updates = 0
+        self.started = 0.0
+        self.timer: Optional[asyncio.Task] = None
+
+    def wrap(self, func):
+        """Для run_blocking: в выключенном состоянии (и на 3.12+) возвращает func как есть."""
+        if not self.active or not self.PER_THREAD:
+            return func
+        def profiled(*args, **kwargs):
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(func, *args, **kwargs)
+            finally:
+                with self.lock:
+                    self.thread_profiles.append(profile)
+        return profiled
+
+    def start(self, application: Application, max_updates: int, max_seconds: float) -> bool:
+        if self.active:
+            return False
+        self.max_updates = max_updates
+        self.seen_updates = 0
+        self.thread_profiles = []
+        self.started = time.perf_counter()
+        self.main_profile = cProfile.Profile()
+        self.active = True
+        self.main_profile.enable()
+        self.timer = asyncio.create_task(self._finish_later(application, max_seconds))
+        return True
+
+    async def _finish_later(self, application: Application, seconds: float) -> None:
+        await asyncio.sleep(seconds)
+        self.timer = None
+        self.finish(application)
+
+    async def on_update(self, update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+        # Срабатывает на (N+1)-м обновлении: к этому моменту N предыдущих уже обработаны
+        self.seen_updates += 1
+        if self.seen_updates > self.max_updates:
+            self.finish(context.application)
+
+    def finish(self, application: Application) -> Optional[str]:
+        if not self.active:
+            return None
+        self.main_profile.disable()
+        self.active = False
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        elapsed = time.perf_counter() - self.started
+        updates = min(self.seen_updates, self.max_updates)
+
+        stats = pstats.Stats(self.main_profile)
+        with self.lock:
+            for profile in self.thread_profiles:
+                stats.add(profile)
+            self.thread_profiles = []
+
+        os.makedirs(PROFILES_DIR, exist_ok=True)
+        path = os.path.join(PROFILES_DIR, f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.prof")
+        stats.dump_stats(path)
+        summary = format_profile_summary(stats, updates, elapsed, path)
+        bot_sender.submit(ADMIN_USER_ID, application.bot.send_message, ADMIN_USER_ID, summary, parse_mode="HTML")
+        return path
+
+
+class ProfilingHook(BaseHandler):
+    """Считает обновления для UpdateProfiler; пока профилирование выключено, не срабатывает."""
+
+    def __init__(self, profiler: UpdateProfiler):
+        super().__init__(profiler.on_update)
+        self.profiler = profiler
+
+    def check_update(self, update: object) -> bool:
+        return self.profiler.active
+
+
+def format_profile_summary(stats: pstats.Stats, updates: int, elapsed: float, path: str) -> str:
+    def describe(func: Tuple[str, int, str]) -> str:
+        filename, line, name = func
+        return f"{name} ({os.path.basename(filename)}:{line})" if line else name
+
+    entries = stats.stats.items()
+    # Функции бота (поиск, NLP, обработчики) — по суммарному времени, все остальные — по собственному
+    own = sorted(
+        ((func, data) for func, data in entries if func[0] == __file__),
+        key=lambda x: x[1][3], reverse=True
+    )[:PROFILE_TOP_FUNCTIONS]
+    hottest = sorted(entries, key=lambda x: x[1][2], reverse=True)[:PROFILE_TOP_FUNCTIONS // 2]
+
+    lines = [f"{'cum мс':>9} {'own мс':>9} {'вызовы':>7}  функция"]
+    for func, (_, calls, own_time, cum_time, _) in own:
+        lines.append(f"{cum_time * 1000:>9.1f} {own_time * 1000:>9.1f} {calls:>7}  {describe(func)}")
+    lines.append("")
+    lines.append("Самые тяжёлые по собственному времени:")
+    for func, (_, calls, own_time, cum_time, _) in hottest:
+        lines.append(f"{cum_time * 1000:>9.1f} {own_time * 1000:>9.1f} {calls:>7}  {describe(func)}")
+
+    return (
+        f"🔬 <b>Профиль готов</b>\nОбновлений: {updates}, время: {elapsed:.1f} с\n"
+        f"Файл: <code>{html.escape(path)}</code>\n\n<pre>{html.escape(chr(10).join(lines))}</pre>"
+    )[:4096]
+
+
+async def run_blocking(func, *args):
+    """Запускает CPU-работу (поиск, NLP) в потоке; при включённом профилировании — под cProfile."""
+    return await asyncio.to_thread(update_profiler.wrap(func), *args)
+
+# ============================================================
+# 🚦 ПЛАНИРОВЩИК ОБНОВЛЕНИЙ
+# ============================================================
+
+# Текстовые вопросы, которые уходят в поиск (тот же фильтр, что у MessageHandler).
+# Только новые сообщения: у отредактированных update.message пуст, а handle_message их не отвечает
+SEARCH_FILTER = filters.UpdateType.MESSAGE & filters.TEXT & ~filters.COMMAND
+
+class UpdateScheduler(BaseUpdateProcessor):
+    """
+    Обновления обрабатываются параллельно, но поиск занимает не больше SEARCH_CONCURRENCY слотов.
+    Кнопки и команды слотов не ждут, поэтому пачка текстовых сообщений не задерживает меню.
+    Вопросы одного пользователя идут строго по очереди — иначе реплики в сессии перепутаются.
+    Флуд-контроль проверяется до очереди: вопросы сверх лимита пользователя не занимают в ней места
+    и не получают отказ "занято". Если в очереди поиска уже SEARCH_QUEUE_SIZE вопросов, новый
+    не обрабатывается: пользователь получает отказ, а счётчик rejected растёт.
+    """
+
+    def __init__(self, max_concurrent: int = UPDATE_MAX_CONCURRENT, search_slots: int = SEARCH_CONCURRENCY,
+                 search_queue_size: int = SEARCH_QUEUE_SIZE):
+        super().__init__(max_concurrent)
+        self.search_slots = asyncio.Semaphore(search_slots)
+        self.search_queue_size = search_queue_size
+        self.waiting = 0
+        self.rejected = 0
+        self.user_locks: Dict[int, asyncio.Lock] = {}
+        self.user_pending: Counter = Counter()
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        if not isinstance(update, Update) or not SEARCH_FILTER.check_update(update):
+            await coroutine
+            return
+
+        user_id = update.effective_user.id if update.effective_user else 0
+        chat_id = update.effective_chat.id
+
+        # 🛡 Флуд отсекается до очереди, поиска, статуса "печатает" и записи файлов
+        admission = flood_control.admit(user_id, "message")
+        if admission != "ok":
+            coroutine.close()
+            if admission == "warn":
+                bot_sender.submit(chat_id, update.message.reply_text, AppleStyleMessages.FLOOD_WARNING, droppable=True)
+            return
+
+        if self.waiting >= self.search_queue_size:
+            coroutine.close()
+            self.rejected += 1
+            bot_sender.submit(chat_id, update.message.reply_text, AppleStyleMessages.SEARCH_BUSY, droppable=True)
+            return
+
+        lock = self.user_locks.setdefault(user_id, asyncio.Lock())
+        self.user_pending[user_id] += 1
+        self.waiting += 1
+        started = False
+        try:
+            async with lock, self.search_slots:
+                self.waiting -= 1
+                started = True
+                await coroutine
+        finally:
+            if not started:
+                self.waiting -= 1
+                coroutine.close()
+            self.user_pending[user_id] -= 1
+            if not self.user_pending[user_id]:
+                del self.user_pending[user_id]
+                del self.user_locks[user_id]
+
 # ============================================================
 # 🌐 ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ
 # ============================================================
 
 kb_index: Optional[KBIndex] = None
 user_contexts: Dict[int, dict] = {}
+bot_sender = BotSender()
+admin_notifier = AdminNotifier(bot_sender)
+update_profiler = UpdateProfiler()
+unknown_store = UnknownQuestionStore(UNKNOWN_FILE)
+feedback_stats = FeedbackStats(FEEDBACK_STATS_FILE)
+flood_control = FloodControl()
+update_scheduler = UpdateScheduler()
+kb_editor = KBEditor()
 
 # ============================================================
 # 🎨 APPLE-STYLE КЛАВИАТУРЫ
@@ -511,6 +2440,8 @@ class AppleKeyboards:
                 InlineKeyboardButton("👎 Дизлайки", callback_data="admin_page_dislike_0")
             ],
             [InlineKeyboardButton("❓ Неизвестные вопросы", callback_data="admin_page_unknown_0")],
+            [InlineKeyboardButton("📊 Оценки ответов", callback_data="admin_page_rating_0")],
+            [InlineKeyboardButton("🔬 Профилирование", callback_data="admin_profile")],
             [InlineKeyboardButton("◀️ Главное меню", callback_data="menu_main")]
         ]
         return InlineKeyboardMarkup(keyboard)
@@ -556,6 +2487,7 @@ def get_user_context(user_id: int) -> dict:
     if user_id not in user_contexts:
         user_contexts[user_id] = {
             "history": deque(maxlen=MAX_HISTORY_LENGTH),
+            "turns": deque(maxlen=CONTEXT_TURNS),
             "last_activity": datetime.now(),
             "question_index_map": {},
         }
@@ -582,19 +2514,24 @@ def get_question_for_answer(user_id: int, answer_index: int) -> str:
     ctx = get_user_context(user_id)
     return ctx.get("question_index_map", {}).get(answer_index, "???")
 
-def get_contextual_question(user_id: int, current_question: str) -> str:
+def get_context_turns(user_id: int, current_question: str) -> List[QueryAnalysis]:
+    """Прошлые разобранные реплики, если текущий вопрос похож на уточнение."""
     ctx = get_user_context(user_id)
-    history = ctx.get("history", [])
-    if not history:
-        return current_question
+    turns = ctx.get("turns")
+    if not turns:
+        return []
     
     context_markers = ['а', 'а есть', 'а как', 'а сколько', 'а скидки', 'а рассрочка', 'а документ']
     q_lower = current_question.lower()
     
     if len(q_lower) < 20 or any(marker in q_lower for marker in context_markers):
-        last_msg = list(history)[-1] if history else ""
-        return f"{last_msg} {current_question}"
-    return current_question
+        for i, turn in enumerate(turns):
+            # Реплики, отвеченные точным совпадением, хранятся текстом и разбираются только по требованию
+            if isinstance(turn, str):
+                turns[i] = analyze_query(turn, kb_index)
+        # После правки базы векторы прошлых реплик годятся, пока не переобучен TF-IDF
+        return [turn for turn in turns if turn.vectorizer is kb_index.tfidf_vectorizer]
+    return []
 
 # ============================================================
 # 📱 ОБРАБОТЧИКИ КОМАНД
@@ -612,21 +2549,23 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     
     text = AppleStyleMessages.WELCOME_RETURNING if is_returning else AppleStyleMessages.WELCOME
     
-    await update.message.reply_text(
+    await bot_sender.call(
+        update.effective_chat.id,
+        update.message.reply_text,
         text, 
         reply_markup=AppleKeyboards.main_menu(is_returning, is_admin),
         parse_mode="HTML"
     )
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await update.message.reply_text(AppleStyleMessages.HELP, parse_mode="HTML")
+    await bot_sender.call(update.effective_chat.id, update.message.reply_text, AppleStyleMessages.HELP, parse_mode="HTML")
 
 async def roadmaps_command(update: Update, context: ContextTypes.DEFAULT_TYPE, edit_mode: bool = False) -> None:
     text = "🗺 <b>Дорожные карты обучения</b>\n\nВыберите направление:"
     if edit_mode and update.callback_query:
-        await update.callback_query.edit_message_text(text, reply_markup=AppleKeyboards.roadmaps_menu(), parse_mode="HTML")
+        await bot_sender.call(update.effective_chat.id, update.callback_query.edit_message_text, text, reply_markup=AppleKeyboards.roadmaps_menu(), parse_mode="HTML")
     else:
-        await update.message.reply_text(text, reply_markup=AppleKeyboards.roadmaps_menu(), parse_mode="HTML")
+        await bot_sender.call(update.effective_chat.id, update.message.reply_text, text, reply_markup=AppleKeyboards.roadmaps_menu(), parse_mode="HTML")
 
 # ============================================================
 # 🎯 ОБРАБОТЧИК CALLBACK-КНОПОК
@@ -635,14 +2574,24 @@ async def roadmaps_command(update: Update, context: ContextTypes.DEFAULT_TYPE, e
 async def menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     data = query.data
-    await query.answer()
-    
     user_id = update.effective_user.id
+    
+    admission = flood_control.admit(user_id, "callback")
+    if admission != "ok":
+        # Ответ на callback всё равно нужен, иначе кнопка "крутится"; текст — только в первый раз
+        text = AppleStyleMessages.FLOOD_WARNING if admission == "warn" else None
+        bot_sender.submit(None, query.answer, text, droppable=True)
+        return
+    
+    await bot_sender.call(None, query.answer)
+    
     is_admin = (user_id == ADMIN_USER_ID)
     update_user_activity(user_id)
     
     if data == "menu_main":
-        await query.edit_message_text(
+        await bot_sender.call(
+            query.message.chat_id,
+            query.edit_message_text,
             AppleStyleMessages.WELCOME_RETURNING,
             reply_markup=AppleKeyboards.main_menu(is_returning=True, is_admin=is_admin),
             parse_mode="HTML"
@@ -651,7 +2600,7 @@ async def menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     
     if data == "menu_consult":
         text = "🗓 <b>Запись на консультацию</b>\n\nВыберите удобный способ:"
-        await query.edit_message_text(text, reply_markup=AppleKeyboards.consult_menu(), parse_mode="HTML")
+        await bot_sender.call(query.message.chat_id, query.edit_message_text, text, reply_markup=AppleKeyboards.consult_menu(), parse_mode="HTML")
         return
     
     if data == "menu_roadmaps":
@@ -660,13 +2609,21 @@ async def menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     
     # --- АДМИН-ПАНЕЛЬ ---
     if data == "admin_panel" and is_admin:
-        await query.edit_message_text(
-            "⚙️ <b>Панель управления</b>",
+        await bot_sender.call(
+            query.message.chat_id,
+            query.edit_message_text,
+            f"⚙️ <b>Панель управления</b>\n\n🛡 Отсечено флуд-контролем: {flood_control.shed_total()}"
+            f"\n🚦 Отказов при перегрузке поиска: {update_scheduler.rejected}",
             reply_markup=AppleKeyboards.admin_panel(),
             parse_mode="HTML"
         )
         return
     
+    if data == "admin_profile" and is_admin:
+        text = start_profiling(context.application, PROFILE_DEFAULT_UPDATES, PROFILE_DEFAULT_SECONDS)
+        await bot_sender.call(query.message.chat_id, query.edit_message_text, text, reply_markup=AppleKeyboards.back_button("admin_panel"), parse_mode="HTML")
+        return
+    
     if data.startswith("admin_page_") and is_admin:
         parts = data.split("_")
         await admin_show_list(update, context, parts[2], int(parts[3]))
@@ -681,21 +2638,15 @@ async def menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         return
     
     # --- СТАНДАРТНЫЕ ВОПРОСЫ ---
-    if data in ["menu_cost", "menu_method", "menu_about"]:
-        q_map = {
-            "menu_cost": "стоимость", 
-            "menu_method": "метод выстраданного познания", 
-            "menu_about": "кто такой алексей"
-        }
-        
+    if data in MENU_QUERIES:
         if not kb_index:
-            await query.edit_message_text("⚠️ База знаний недоступна", reply_markup=AppleKeyboards.back_button())
+            await bot_sender.call(query.message.chat_id, query.edit_message_text, "⚠️ База знаний недоступна", reply_markup=AppleKeyboards.back_button())
             return
         
-        answer, score, candidates = search_knowledge_base(q_map[data], kb_index)
+        answer, score, candidates = search_knowledge_base(MENU_QUERIES[data], kb_index)
         
         if not answer:
-            await query.edit_message_text(AppleStyleMessages.NOT_FOUND, reply_markup=AppleKeyboards.back_button(), parse_mode="HTML")
+            await bot_sender.call(query.message.chat_id, query.edit_message_text, AppleStyleMessages.NOT_FOUND, reply_markup=AppleKeyboards.back_button(), parse_mode="HTML")
             return
         
         # Формируем ответ
@@ -707,11 +2658,11 @@ async def menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             ans_idx = candidates[0]['index']
         else:
             for i, item in enumerate(kb_index.items):
-                if item['context'] == answer:
+                if item.context == answer:
                     ans_idx = i
                     break
         
-        save_question_for_answer(user_id, ans_idx, q_map[data])
+        save_question_for_answer(user_id, ans_idx, MENU_QUERIES[data])
         
         # ✨ МАГИЯ: Добавляем умные кнопки и кнопку записи
         smart_btns = generate_smart_buttons(display_text)
@@ -725,7 +2676,9 @@ async def menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         # Наводим красоту
         display_text = beautify_text(display_text)
         
-        await query.edit_message_text(
+        await bot_sender.call(
+            query.message.chat_id,
+            query.edit_message_text,
             display_text,
             reply_markup=InlineKeyboardMarkup(all_buttons),
             disable_web_page_preview=True,
@@ -736,15 +2689,15 @@ async def menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     # --- УТОЧНЕНИЕ ---
     if data.startswith("clarify_"):
         if data == "clarify_none":
-            await query.edit_message_text("Хорошо, попробуйте сформулировать иначе.", reply_markup=AppleKeyboards.back_button())
+            await bot_sender.call(query.message.chat_id, query.edit_message_text, "Хорошо, попробуйте сформулировать иначе.", reply_markup=AppleKeyboards.back_button())
             return
         
         idx = int(data.split("_")[1])
         if not kb_index or not kb_index.is_valid_index(idx):
-            await query.answer("Ответ не найден", show_alert=True)
+            await bot_sender.call(None, query.answer, "Ответ не найден", show_alert=True)
             return
         
-        context_data = kb_index.items[idx]["context"]
+        context_data = kb_index.items[idx].context
         clean_text = context_data.replace("[add_button]", "").strip()
         display_text, url_buttons = extract_links_and_buttons(clean_text)
         
@@ -760,7 +2713,7 @@ async def menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         
         display_text = beautify_text(display_text)
         
-        await query.edit_message_text(display_text, reply_markup=InlineKeyboardMarkup(all_buttons), parse_mode="HTML", disable_web_page_preview=True)
+        await bot_sender.call(query.message.chat_id, query.edit_message_text, display_text, reply_markup=InlineKeyboardMarkup(all_buttons), parse_mode="HTML", disable_web_page_preview=True)
         return
     
     if data == "consultation":
@@ -783,38 +2736,45 @@ async def consultation_callback(update: Update, context: ContextTypes.DEFAULT_TY
     user = query.from_user
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     
-    consultations = load_json(CONSULTATIONS_FILE)
-    recent_consultations = [
-        c for c in consultations
-        if c.get("user_id") == user.id and
-        datetime.now() - datetime.strptime(c.get("timestamp", "2000-01-01"), "%Y-%m-%d %H:%M:%S") < timedelta(hours=24)
-    ]
+    # Файл общий для воркеров: чтение, проверка и запись — под одной блокировкой, иначе заявки теряются
+    with file_lock(CONSULTATIONS_FILE):
+        consultations = load_json(CONSULTATIONS_FILE)
+        recent_consultations = [
+            c for c in consultations
+            if c.get("user_id") == user.id and
+            datetime.now() - datetime.strptime(c.get("timestamp", "2000-01-01"), "%Y-%m-%d %H:%M:%S") < timedelta(hours=24)
+        ]
+        if not recent_consultations:
+            consultations.append({
+                "user_id": user.id, "username": user.username or "Нет", "first_name": user.first_name or "",
+                "last_name": user.last_name or "", "timestamp": timestamp
+            })
+            save_json(CONSULTATIONS_FILE, consultations)
     
     if recent_consultations:
-        await query.edit_message_text(
+        await bot_sender.call(
+            query.message.chat_id,
+            query.edit_message_text,
             "✅ <b>Вы уже записаны</b>\n\nВаша заявка обрабатывается.",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("📅 Календарь", url=CALENDAR_URL)]]),
             parse_mode="HTML"
         )
         return
     
-    consultations.append({
-        "user_id": user.id, "username": user.username or "Нет", "first_name": user.first_name or "",
-        "last_name": user.last_name or "", "timestamp": timestamp
-    })
-    save_json(CONSULTATIONS_FILE, consultations)
-    
-    try:
-        await context.bot.send_message(
-            ADMIN_USER_ID,
-            f"🔔 <b>Новая заявка!</b>\n👤 {user.first_name}\n📱 @{user.username}\n🆔 {user.id}",
-            parse_mode="HTML"
+    # Имя и username задаёт пользователь: без экранирования "<" или "&" ломают HTML срочного сообщения,
+    # а BadRequest не повторяется — администратор потерял бы уведомление о заявке
+    admin_notifier.notify(
+        context.bot,
+        "consult",
+        f"{user.first_name} @{user.username} ({user.id})",
+        urgent_text=(
+            f"🔔 <b>Новая заявка!</b>\n👤 {html.escape(str(user.first_name))}\n📱 @{html.escape(str(user.username))}\n🆔 {user.id}"
+            if ADMIN_URGENT_CONSULTATIONS else None
         )
-    except Exception as e:
-        logger.error(f"Failed to notify admin: {e}")
+    )
     
     keyboard = [[InlineKeyboardButton("📅 Выбрать время в календаре", url=CALENDAR_URL)]]
-    await query.edit_message_text(AppleStyleMessages.CONSULTATION_SUCCESS, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="HTML")
+    await bot_sender.call(query.message.chat_id, query.edit_message_text, AppleStyleMessages.CONSULTATION_SUCCESS, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="HTML")
 
 # ============================================================
 # 💚 ОБРАТНАЯ СВЯЗЬ
@@ -824,41 +2784,41 @@ async def feedback_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     query = update.callback_query
     data = query.data
     user = query.from_user
-    await query.answer()
+    await bot_sender.call(None, query.answer)
     
     fb_type = "like" if data.startswith("like_") else "dislike"
     try:
         idx = int(data.split("_")[1])
     except (IndexError, ValueError):
-        await query.answer("Ошибка данных", show_alert=True)
+        await bot_sender.call(None, query.answer, "Ошибка данных", show_alert=True)
         return
     
     if not kb_index or not kb_index.is_valid_index(idx):
-        await query.answer("Ошибка", show_alert=True)
+        await bot_sender.call(None, query.answer, "Ошибка", show_alert=True)
         return
     
-    answer = kb_index.items[idx]["context"]
+    answer = kb_index.items[idx].context
     question = get_question_for_answer(user.id, idx)
     if question == "???":
         ctx = get_user_context(user.id)
         if ctx.get("history"): question = list(ctx["history"])[-1]
     
-    feedback_list = load_json(FEEDBACK_FILE)
-    feedback_list.append({
-        "type": fb_type, "question": question,
-        "answer": answer[:200], "user_id": user.id,
-        "username": user.username, "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    })
-    save_json(FEEDBACK_FILE, feedback_list)
+    with file_lock(FEEDBACK_FILE):
+        feedback_list = load_json(FEEDBACK_FILE)
+        feedback_list.append({
+            "type": fb_type, "question": question,
+            "answer": answer[:200], "user_id": user.id,
+            "username": user.username, "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        })
+        save_json(FEEDBACK_FILE, feedback_list)
+    feedback_stats.record(kb_index.items[idx], fb_type, kb_index)
     
     if fb_type == "like":
-        await query.edit_message_reply_markup(InlineKeyboardMarkup([[InlineKeyboardButton("💚 Спасибо!", callback_data="ignore")]]))
+        await bot_sender.call(query.message.chat_id, query.edit_message_reply_markup, InlineKeyboardMarkup([[InlineKeyboardButton("💚 Спасибо!", callback_data="ignore")]]))
     else:
-        await query.edit_message_reply_markup(InlineKeyboardMarkup([[InlineKeyboardButton("📝 Отправлено", callback_data="ignore")]]))
-        await query.message.reply_text(AppleStyleMessages.FEEDBACK_DISLIKE, parse_mode="HTML")
-        try:
-            await context.bot.send_message(ADMIN_USER_ID, f"👎 Дизлайк\n❓ {question}\n💬 {answer[:100]}", parse_mode="HTML")
-        except: pass
+        await bot_sender.call(query.message.chat_id, query.edit_message_reply_markup, InlineKeyboardMarkup([[InlineKeyboardButton("📝 Отправлено", callback_data="ignore")]]))
+        await bot_sender.call(query.message.chat_id, query.message.reply_text, AppleStyleMessages.FEEDBACK_DISLIKE, parse_mode="HTML")
+        admin_notifier.notify(context.bot, "dislike", f"{question[:50]} → {answer[:60]}")
 
 # ============================================================
 # 💬 ГЛАВНЫЙ ОБРАБОТЧИК СООБЩЕНИЙ
@@ -869,24 +2829,41 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
     
     user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
     user_question = update.message.text.strip()
     
     cleanup_inactive_users()
     
-    # 🎨 Apple Touch: Статус "печатает"
-    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
-    # Небольшая пауза для естественности (опционально)
-    # await asyncio.sleep(0.5)
+    # 🎨 Apple Touch: Статус "печатает" — отправляется параллельно с поиском, не задерживая ответ
+    bot_sender.submit(chat_id, context.bot.send_chat_action, chat_id=chat_id, action="typing", droppable=True)
     
     get_user_context(user_id)
     update_user_activity(user_id)
     user_contexts[user_id]["history"].append(user_question)
     
-    search_query = get_contextual_question(user_id, user_question)
-    answer, score, candidates = search_knowledge_base(search_query, kb_index)
+    # Бюджет времени на весь каскад: поиск, повтор по сырому тексту и нечёткий поиск
+    deadline = time.monotonic() + SEARCH_TIME_BUDGET_SECONDS
+    # Одна версия индекса на весь ответ: правка базы между await не смешает номера записей
+    index = kb_index
+    
+    # ⚡ Приветствия, кнопки и точные ключевые фразы отвечаются из таблицы, без поиска
+    canned = index.exact_match(user_question)
+    analysis = None
+    if canned is not None:
+        answer, score, candidates = canned
+        user_contexts[user_id]["turns"].append(preprocess_question(user_question))
+    else:
+        context_turns = get_context_turns(user_id, user_question)
+        # Поиск — CPU-работа: выносим в поток, чтобы event loop успел отправить "печатает"
+        analysis = await run_blocking(analyze_query, preprocess_question(user_question), index)
+        answer, score, candidates = await run_blocking(
+            search_knowledge_base, user_question, index, context_turns, analysis, feedback_stats, deadline
+        )
+        # Разобранная реплика остаётся в сессии: следующему уточнению не нужно разбирать её заново
+        user_contexts[user_id]["turns"].append(analysis)
     final_answer = None
     
-    if score > 3.5 and answer:
+    if score > CONFIDENT_SCORE and answer:
         final_answer = answer
     elif score > 1.5 and candidates:
         keyboard = [
@@ -894,25 +2871,29 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             for c in candidates
         ]
         keyboard.append([InlineKeyboardButton("❌ Не то", callback_data="clarify_none")])
-        await update.message.reply_text(AppleStyleMessages.CLARIFY_PROMPT, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="HTML")
+        await bot_sender.call(chat_id, update.message.reply_text, AppleStyleMessages.CLARIFY_PROMPT, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="HTML")
         return
-    elif FUZZY_ENABLED:
-        suggestion = get_fuzzy_suggestion(user_question, kb_index)
+    elif FUZZY_ENABLED and time.monotonic() < deadline:
+        # Нечёткий поиск — последний и самый дорогой этап каскада: только если бюджет ещё не исчерпан
+        fuzzy_query = analysis.question_lower if analysis is not None else preprocess_text(user_question)
+        suggestion = await run_blocking(get_fuzzy_suggestion, fuzzy_query, index)
         if suggestion:
-            answer, score, candidates = search_knowledge_base(suggestion, kb_index)
+            answer, score, candidates = await run_blocking(
+                search_knowledge_base, suggestion, index, None, None, None, deadline
+            )
             if score > 1.5: final_answer = answer
-            if score < 3.5 and candidates:
+            if score < CONFIDENT_SCORE and candidates:
                 keyboard = [[InlineKeyboardButton(f"💡 {suggestion}?", callback_data=f"clarify_{candidates[0]['index']}")]]
-                await update.message.reply_text(AppleStyleMessages.FUZZY_SUGGESTION, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="HTML")
+                await bot_sender.call(chat_id, update.message.reply_text, AppleStyleMessages.FUZZY_SUGGESTION, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="HTML")
                 return
     
     if not final_answer:
-        unk = load_json(UNKNOWN_FILE)
-        unk.append({"question": user_question, "user_id": user_id, "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")})
-        save_json(UNKNOWN_FILE, unk)
+        unknown_store.add(user_question, user_id)
         
         is_admin = (user_id == ADMIN_USER_ID)
-        await update.message.reply_text(
+        await bot_sender.call(
+            chat_id,
+            update.message.reply_text,
             AppleStyleMessages.NOT_FOUND, 
             reply_markup=AppleKeyboards.main_menu(is_returning=True, is_admin=is_admin), 
             parse_mode="HTML"
@@ -928,8 +2909,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if candidates and candidates[0]['context'] == final_answer:
         ans_idx = candidates[0]['index']
     else:
-        for i, item in enumerate(kb_index.items):
-            if item['context'] == final_answer:
+        for i, item in enumerate(index.items):
+            if item.context == final_answer:
                 ans_idx = i
                 break
     
@@ -949,7 +2930,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     # 🎨 Apple Touch: Визуальная чистота
     display_text = beautify_text(display_text)
     
-    await update.message.reply_text(
+    await bot_sender.call(
+        chat_id,
+        update.message.reply_text,
         display_text,
         reply_markup=InlineKeyboardMarkup(all_buttons),
         disable_web_page_preview=True,
@@ -962,7 +2945,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 async def admin_show_list(update: Update, context: ContextTypes.DEFAULT_TYPE, data_type: str, page: int = 0):
     query = update.callback_query
-    if query: await query.answer()
+    if query: await bot_sender.call(None, query.answer)
     
     items = []
     title = ""
@@ -985,10 +2968,16 @@ async def admin_show_list(update: Update, context: ContextTypes.DEFAULT_TYPE, da
         empty_msg = "Жалоб нет."
         clear_callback = "admin_clear_dislike"
     elif data_type == "unknown":
-        items = load_json(UNKNOWN_FILE)
+        # Сначала самые частые пробелы в базе знаний
+        items = sorted(unknown_store.all(), key=lambda x: x.get("count", 1), reverse=True)
         title = "❓ Неизвестные"
         empty_msg = "Бот знает всё."
         clear_callback = "admin_clear_unknown"
+    elif data_type == "rating":
+        items = feedback_stats.ranking(kb_index)
+        title = "📊 Оценки ответов"
+        empty_msg = "Оценок пока нет."
+        clear_callback = "admin_clear_rating"
     
     total_items = len(items)
     total_pages = math.ceil(total_items / ITEMS_PER_PAGE) if total_items > 0 else 1
@@ -1004,9 +2993,13 @@ async def admin_show_list(update: Update, context: ContextTypes.DEFAULT_TYPE, da
         for i, item in enumerate(current_items, start=start_idx + 1):
             if data_type == "consult":
                 text += f"{i}. {item.get('first_name', '')} @{item.get('username', '')}\n⏰ {item.get('timestamp', '')}\n\n"
+            elif data_type == "rating":
+                text += f"{i}. {html.escape(item['topic'][:40])}\n👍 {item['like']}  👎 {item['dislike']}\n\n"
             else:
                 q = item.get('question', '???')
-                text += f"{i}. {q[:50]}...\n\n"
+                count = item.get('count', 1)
+                suffix = f" <i>×{count}</i>" if count > 1 else ""
+                text += f"{i}. {q[:50]}...{suffix}\n\n"
     
     keyboard = []
     if total_pages > 1:
@@ -1020,28 +3013,136 @@ async def admin_show_list(update: Update, context: ContextTypes.DEFAULT_TYPE, da
     keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="admin_panel")])
     
     if query:
-        try: await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="HTML")
-        except: pass
-    else: await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="HTML")
+        # BadRequest "message is not modified" — повторное нажатие на ту же страницу
+        try: await bot_sender.call(query.message.chat_id, query.edit_message_text, text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="HTML")
+        except BadRequest: pass
+    else: await bot_sender.call(update.effective_chat.id, update.message.reply_text, text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="HTML")
 
 async def admin_clear_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE, data_type: str):
     query = update.callback_query
-    await query.answer()
+    await bot_sender.call(None, query.answer)
     keyboard = [
         [InlineKeyboardButton("✅ Да, очистить", callback_data=f"admin_do_clear_{data_type}")],
         [InlineKeyboardButton("❌ Отмена", callback_data=f"admin_page_{data_type}_0")]
     ]
-    await query.edit_message_text("⚠️ <b>Подтвердите очистку</b>", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="HTML")
+    await bot_sender.call(query.message.chat_id, query.edit_message_text, "⚠️ <b>Подтвердите очистку</b>", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="HTML")
 
 async def admin_do_clear(update: Update, context: ContextTypes.DEFAULT_TYPE, data_type: str):
     query = update.callback_query
-    await query.answer()
-    if data_type == "consult": save_json(CONSULTATIONS_FILE, [])
+    await bot_sender.call(None, query.answer)
+    if data_type == "consult":
+        with file_lock(CONSULTATIONS_FILE):
+            save_json(CONSULTATIONS_FILE, [])
     elif data_type in ["like", "dislike"]:
-        fb = load_json(FEEDBACK_FILE)
-        save_json(FEEDBACK_FILE, [x for x in fb if x.get("type") != data_type])
-    elif data_type == "unknown": save_json(UNKNOWN_FILE, [])
-    await query.edit_message_text("✅ Очищено", parse_mode="HTML")
+        with file_lock(FEEDBACK_FILE):
+            fb = load_json(FEEDBACK_FILE)
+            save_json(FEEDBACK_FILE, [x for x in fb if x.get("type") != data_type])
+    elif data_type == "unknown": unknown_store.clear()
+    elif data_type == "rating": feedback_stats.clear()
+    await bot_sender.call(query.message.chat_id, query.edit_message_text, "✅ Очищено", parse_mode="HTML")
+
+def start_profiling(application: Application, max_updates: int, max_seconds: float) -> str:
+    if not update_profiler.start(application, max_updates, max_seconds):
+        return "🔬 Профилирование уже идёт. Остановить: /profile stop"
+    return (
+        f"🔬 <b>Профилирование запущено</b>\n\n"
+        f"Следующие {max_updates} обновлений или {int(max_seconds)} с — что наступит раньше.\n"
+        f"Сводка придёт сообщением, полный профиль сохранится в <code>{PROFILES_DIR}/</code>."
+    )
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/profile [N] [Ts] — профилировать N обновлений и/или T секунд; /profile stop — остановить."""
+    if update.effective_user.id != ADMIN_USER_ID:
+        return
+    
+    max_updates, max_seconds = PROFILE_DEFAULT_UPDATES, PROFILE_DEFAULT_SECONDS
+    for arg in context.args:
+        if arg == "stop":
+            path = update_profiler.finish(context.application)
+            await bot_sender.call(update.effective_chat.id, update.message.reply_text, "🔬 Остановлено" if path else "🔬 Профилирование не запущено")
+            return
+        try:
+            if arg.endswith("s"):
+                max_seconds = min(float(arg[:-1]), PROFILE_MAX_SECONDS)
+                # Указано только время — не ограничиваем число обновлений
+                if len(context.args) == 1:
+                    max_updates = 10 ** 9
+            else:
+                max_updates = int(arg)
+        except ValueError:
+            await bot_sender.call(update.effective_chat.id, update.message.reply_text, "Использование: /profile [N] [Ts] | /profile stop")
+            return
+    
+    await bot_sender.call(update.effective_chat.id, update.message.reply_text, start_profiling(context.application, max_updates, max_seconds), parse_mode="HTML")
+
+def parse_kb_entry(body: str) -> Optional[Tuple[List[str], str]]:
+    """Первая строка — ключевые фразы через ";", остальное — текст ответа (HTML)."""
+    first_line, _, answer = body.partition("\n")
+    keywords = [keyword.strip() for keyword in first_line.split(";") if keyword.strip()]
+    answer = answer.strip()
+    return (keywords, answer) if keywords and answer else None
+
+def format_kb_entry(idx: int) -> str:
+    item = kb_index.items[idx]
+    return f"<code>/kb_edit {idx} {html.escape('; '.join(item.original_keywords))}\n{html.escape(item.context)}</code>"
+
+async def kb_add_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/kb_add фраза; фраза\nтекст ответа — добавить запись."""
+    if update.effective_user.id != ADMIN_USER_ID:
+        return
+    parts = update.message.text.split(None, 1)
+    entry = parse_kb_entry(parts[1]) if len(parts) > 1 else None
+    if entry is None:
+        await bot_sender.call(update.effective_chat.id, update.message.reply_text, "Использование:\n/kb_add фраза; фраза\nтекст ответа")
+        return
+    started = time.perf_counter()
+    idx = await kb_editor.apply(None, *entry)
+    await bot_sender.call(
+        update.effective_chat.id,
+        update.message.reply_text,
+        f"✅ Запись #{idx} добавлена за {(time.perf_counter() - started) * 1000:.0f} мс", parse_mode="HTML"
+    )
+
+async def kb_edit_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/kb_edit N — показать запись; /kb_edit N фраза; фраза\nтекст ответа — заменить."""
+    if update.effective_user.id != ADMIN_USER_ID:
+        return
+    parts = update.message.text.split(None, 2)
+    try:
+        idx = int(parts[1])
+    except (IndexError, ValueError):
+        idx = -1
+    if not kb_index.is_valid_index(idx):
+        await bot_sender.call(update.effective_chat.id, update.message.reply_text, "Использование:\n/kb_edit N — показать запись\n/kb_edit N фраза; фраза\nтекст ответа")
+        return
+    if len(parts) < 3:
+        await bot_sender.call(update.effective_chat.id, update.message.reply_text, format_kb_entry(idx), parse_mode="HTML")
+        return
+    entry = parse_kb_entry(parts[2])
+    if entry is None:
+        await bot_sender.call(update.effective_chat.id, update.message.reply_text, "Нужны ключевые фразы в первой строке и текст ответа со второй.")
+        return
+    started = time.perf_counter()
+    if await kb_editor.apply(idx, *entry) is None:
+        await bot_sender.call(update.effective_chat.id, update.message.reply_text, f"Запись #{idx} уже удалена.")
+        return
+    await bot_sender.call(update.effective_chat.id, update.message.reply_text, f"✅ Запись #{idx} обновлена за {(time.perf_counter() - started) * 1000:.0f} мс")
+
+async def kb_del_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/kb_del N — удалить запись."""
+    if update.effective_user.id != ADMIN_USER_ID:
+        return
+    try:
+        idx = int(context.args[0])
+    except (IndexError, ValueError):
+        idx = -1
+    if not kb_index.is_valid_index(idx):
+        await bot_sender.call(update.effective_chat.id, update.message.reply_text, "Использование: /kb_del N")
+        return
+    if await kb_editor.apply(idx, [], "") is None:
+        await bot_sender.call(update.effective_chat.id, update.message.reply_text, f"Запись #{idx} уже удалена.")
+        return
+    await bot_sender.call(update.effective_chat.id, update.message.reply_text, f"🗑 Запись #{idx} удалена")
 
 # ============================================================
 # ⚠️ ОБРАБОТЧИК ОШИБОК
@@ -1050,37 +3151,144 @@ async def admin_do_clear(update: Update, context: ContextTypes.DEFAULT_TYPE, dat
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.error("Exception:", exc_info=context.error)
     if update and hasattr(update, 'effective_message') and update.effective_message:
-        try: await update.effective_message.reply_text("⚠️ Произошла ошибка. Попробуйте позже.", parse_mode="HTML")
+        try: await bot_sender.call(update.effective_chat.id, update.effective_message.reply_text, "⚠️ Произошла ошибка. Попробуйте позже.", parse_mode="HTML")
         except: pass
 
 # ============================================================
 # 🚀 ЗАПУСК
 # ============================================================
 
+async def on_startup(application: Application) -> None:
+    # Счётчики оценок нужны поиску с первого сообщения, а не с первой оценки
+    feedback_stats.load(kb_index)
+    await bot_sender.start(application)
+    await kb_editor.start(application)
+
+async def on_shutdown(application: Application) -> None:
+    # Сначала досылаем накопленную сводку, потом останавливаем очередь отправки
+    await kb_editor.stop(application)
+    await admin_notifier.stop(application)
+    await bot_sender.stop(application)
+
+def build_application(token: str, base_url: Optional[str] = None) -> Application:
+    builder = (
+        Application.builder()
+        .token(token)
+        .connection_pool_size(OUTBOUND_POOL_SIZE)
+        .concurrent_updates(update_scheduler)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if base_url:
+        # Другой адрес Bot API: локальный сервер или фейковый API нагрузочного теста
+        builder = builder.base_url(base_url)
+    application = builder.build()
+    
+    application.add_handler(ProfilingHook(update_profiler), group=-1)
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("roadmaps", roadmaps_command))
+    application.add_handler(CommandHandler("profile", profile_command))
+    application.add_handler(CommandHandler("kb_add", kb_add_command))
+    application.add_handler(CommandHandler("kb_edit", kb_edit_command))
+    application.add_handler(CommandHandler("kb_del", kb_del_command))
+    application.add_handler(CallbackQueryHandler(menu_callback))
+    application.add_handler(MessageHandler(SEARCH_FILTER, handle_message))
+    application.add_error_handler(error_handler)
+    return application
+
+def run_application(application: Application, worker_id: int = 0) -> None:
+    if WEBHOOK_URL:
+        # Каждый воркер слушает свой порт, балансировщик раскладывает вебхуки между ними
+        application.run_webhook(listen="0.0.0.0", port=WEBHOOK_PORT + worker_id, webhook_url=WEBHOOK_URL)
+    else:
+        application.run_polling()
+
+def run_worker(worker_id: int, index_dir: str, token: str, workers: int = 1) -> None:
+    global kb_index
+    # Обработчик SIGTERM супервизора унаследован через fork — воркер завершается по умолчанию (PTB ставит свой)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # Лимит Telegram общий на бота: воркеры делят его поровну
+    bot_sender.global_bucket = TokenBucket(OUTBOUND_GLOBAL_RATE / workers, OUTBOUND_GLOBAL_RATE / workers)
+    kb_index = attach_kb_index(index_dir)
+    # Правки после публикации индекса kb_editor дочитает из файла при старте
+    kb_editor.version = kb_index.source_version
+    logger.info(f"Worker {worker_id} attached to shared index: {len(kb_index.items)} записей")
+    run_application(build_application(token), worker_id)
+
+def run_supervisor(workers: int, index_dir: str, token: str) -> None:
+    """
+    Строит индекс один раз, публикует его в index_dir и запускает воркеры.
+    Упавший воркер перезапускается. История диалогов у каждого воркера своя.
+    SIGTERM, как и Ctrl+C, останавливает супервизор вместе с воркерами.
+    """
+    if workers > 1 and not WEBHOOK_URL:
+        raise ValueError("❌ Для нескольких воркеров нужен WEBHOOK_URL: polling допускает только один процесс")
+    
+    source_version = file_version(KB_FILE)
+    export_kb_index(preprocess_knowledge_base(iter_knowledge_base(KB_FILE)), index_dir, source_version)
+    print(f"✅ Индекс опубликован в {index_dir}")
+    
+    # fork: воркеры наследуют загруженный pymorphy2 и стартуют без повторного импорта
+    mp = multiprocessing.get_context("fork")
+    processes = {}
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        while True:
+            for worker_id in range(workers):
+                proc = processes.get(worker_id)
+                if proc is not None and proc.is_alive():
+                    continue
+                if proc is not None:
+                    logger.warning(f"Worker {worker_id} exited with code {proc.exitcode}, restarting")
+                proc = mp.Process(target=run_worker, args=(worker_id, index_dir, token, workers), daemon=False)
+                proc.start()
+                processes[worker_id] = proc
+            time.sleep(WORKER_RESTART_DELAY)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for proc in processes.values():
+            proc.terminate()
+        for proc in processes.values():
+            proc.join()
+
 def main() -> None:
     global kb_index
+    parser = argparse.ArgumentParser(description="Прогресс Бот")
+    parser.add_argument("--workers", type=int, default=0, help="запустить супервизор с N воркерами")
+    parser.add_argument("--attach", action="store_true", help="подключиться к уже опубликованному индексу")
+    parser.add_argument("--index-dir", default=SHARED_INDEX_DIR, help="каталог общего индекса")
+    parser.add_argument("--memory-report", action="store_true", help="показать расход памяти индекса и выйти")
+    args = parser.parse_args()
+    
+    if args.memory_report:
+        print_memory_report(preprocess_knowledge_base(iter_knowledge_base(KB_FILE)))
+        return
+    
     token = os.getenv("BOT_TOKEN")
     if not token: raise ValueError("❌ Токен не найден")
     
+    if args.workers > 0:
+        run_supervisor(args.workers, args.index_dir, token)
+        return
+    
     try:
-        kb = load_knowledge_base('main.json')
-        kb_index = preprocess_knowledge_base(kb)
+        if args.attach:
+            kb_index = attach_kb_index(args.index_dir)
+            kb_editor.version = kb_index.source_version
+        else:
+            kb_editor.version = file_version(KB_FILE)
+            kb_index = preprocess_knowledge_base(iter_knowledge_base(KB_FILE))
         print(f"✅ База знаний загружена: {len(kb_index.items)} записей")
     except Exception as e:
         print(f"❌ Ошибка загрузки базы знаний: {str(e)}")
         return
     
-    application = Application.builder().token(token).build()
-    
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("roadmaps", roadmaps_command))
-    application.add_handler(CallbackQueryHandler(menu_callback))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    application.add_error_handler(error_handler)
+    application = build_application(token)
     
     print("🚀 Бот запущен (Apple Magic Mode)")
-    application.run_polling()
+    run_application(application)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,313 @@
+"""
+🔌 Локальный HTTP API поиска Прогресс Бота — тот же индекс и каскад, что отвечает в Telegram.
+- POST /search  {"query": "сколько стоит обучение"}  или  GET /search?q=...
+  -> {"query", "answer", "score", "confident", "candidates": [{"index", "id", "topic", "score", "context"}]}
+- GET /health — размер и версия индекса; GET /stats — очередь и размеры пакетов.
+- Одновременные запросы собираются в микропакеты: до --batch-size вопросов или --batch-wait мс
+  от первого вопроса пакета, и считаются одним вызовом search_knowledge_base_batch.
+
+Запуск: python search_api.py --port 8080 [--attach --index-dir /dev/shm/progress_bot_index]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import main
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8080
+BATCH_MAX_SIZE = 32
+BATCH_MAX_WAIT_MS = 5.0
+BATCH_QUEUE_SIZE = 1000       # сверх этого запросы получают 503
+MAX_BODY_BYTES = 64 * 1024
+MAX_QUERY_CHARS = 1000
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 503: "Service Unavailable"}
+
+logger = logging.getLogger("search_api")
+
+
+class ApiError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+# ============================================================
+# 📦 МИКРОПАКЕТЫ
+# ============================================================
+
+class MicroBatcher:
+    """
+    Очередь вопросов от всех соединений. Один обработчик берёт первый вопрос, добирает остальные,
+    пока пакет не заполнится или не истечёт max_wait, и считает пакет в потоке (run_blocking).
+    Пока пакет считается, следующий копится в очереди — под нагрузкой пакеты растут сами.
+    """
+
+    def __init__(self, max_size: int = BATCH_MAX_SIZE, max_wait: float = BATCH_MAX_WAIT_MS / 1000,
+                 queue_size: int = BATCH_QUEUE_SIZE, feedback: Optional[main.FeedbackStats] = None):
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.feedback = feedback
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.task: Optional[asyncio.Task] = None
+        self.batch_sizes: Counter = Counter()
+        self.rejected = 0
+        self.search_seconds = 0.0
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def search(self, question: str) -> Tuple[Optional[str], float, List[dict], main.KBIndex]:
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((question, future))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise ApiError(503, "search queue is full")
+        return await future
+
+    async def _collect(self) -> List[Tuple[str, asyncio.Future]]:
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_size:
+            # Всё, что уже в очереди, забираем без ожидания; ждём только пустую очередь
+            if self.queue.empty():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            else:
+                batch.append(self.queue.get_nowait())
+        # Клиент мог отключиться, пока вопрос ждал в очереди
+        return [(question, future) for question, future in batch if not future.done()]
+
+    async def _run(self) -> None:
+        while True:
+            batch = await self._collect()
+            if not batch:
+                continue
+            # Пакет целиком считается на одной версии индекса
+            kb_index = main.kb_index
+            started = time.perf_counter()
+            try:
+                results = await main.run_blocking(
+                    main.search_knowledge_base_batch, [question for question, _ in batch], kb_index, self.feedback
+                )
+            except Exception as e:
+                logger.exception("Batch search failed")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.search_seconds += time.perf_counter() - started
+            self.batch_sizes[len(batch)] += 1
+            for (_, future), (answer, score, candidates) in zip(batch, results):
+                if not future.done():
+                    future.set_result((answer, score, candidates, kb_index))
+
+    def stats(self) -> dict:
+        batches = sum(self.batch_sizes.values())
+        searched = sum(size * count for size, count in self.batch_sizes.items())
+        return {
+            "queued": self.queue.qsize(),
+            "batches": batches,
+            "searched": searched,
+            "rejected": self.rejected,
+            "mean_batch_size": round(searched / batches, 2) if batches else 0.0,
+            "max_batch_size": max(self.batch_sizes, default=0),
+            "search_ms_per_query": round(self.search_seconds / searched * 1000, 3) if searched else 0.0,
+        }
+
+# ============================================================
+# 🌐 HTTP
+# ============================================================
+
+def format_result(question: str, answer: Optional[str], score: float, candidates: List[dict],
+                  kb_index: main.KBIndex) -> dict:
+    return {
+        "query": question,
+        "answer": answer,
+        "score": round(float(score), 4),
+        "confident": bool(answer) and score > main.CONFIDENT_SCORE,
+        "candidates": [
+            {
+                "index": candidate["index"],
+                "id": kb_index.items[candidate["index"]].item_id,
+                "topic": candidate["topic"],
+                "score": round(float(candidate["score"]), 4),
+                "context": candidate["context"],
+            }
+            for candidate in candidates
+        ],
+    }
+
+
+class SearchAPI:
+    """Минимальный HTTP/1.1 сервер с keep-alive поверх asyncio: JSON-ответы, без внешних зависимостей."""
+
+    def __init__(self, batcher: MicroBatcher):
+        self.batcher = batcher
+        self.requests: Counter = Counter()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                lines = head.decode("latin-1").split("\r\n")
+                request_line = lines[0].split(" ")
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        key, value = line.split(":", 1)
+                        headers[key.strip().lower()] = value.strip()
+                keep_alive = headers.get("connection", "").lower() != "close" and request_line[-1] == "HTTP/1.1"
+
+                # Без верной длины не найти конец тела — отвечаем и закрываем соединение
+                length_header = headers.get("content-length", "0") or "0"
+                if not length_header.isdigit():
+                    self.requests[400] += 1
+                    await self._respond(writer, 400, {"error": "invalid Content-Length"}, keep_alive=False)
+                    break
+                length = int(length_header)
+                if length > MAX_BODY_BYTES:
+                    await self._respond(writer, 413, {"error": "request body is too large"}, keep_alive=False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+
+                try:
+                    if len(request_line) != 3:
+                        raise ApiError(400, "malformed request line")
+                    status, payload = 200, await self.dispatch(request_line[0].upper(), request_line[1], headers, body)
+                except ApiError as e:
+                    status, payload = e.status, {"error": str(e)}
+                except Exception:
+                    logger.exception("Search API request failed")
+                    status, payload = 503, {"error": "search failed"}
+                self.requests[status] += 1
+                await self._respond(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except asyncio.CancelledError:
+            # Отменённую задачу соединения asyncio (3.11) логирует как ошибку — завершаемся штатно
+            pass
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: int, payload: dict, keep_alive: bool) -> None:
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+            f"Content-Type: application/json; charset=utf-8\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1")
+            + data
+        )
+        await writer.drain()
+
+    async def dispatch(self, method: str, target: str, headers: Dict[str, str], body: bytes) -> dict:
+        url = urlsplit(target)
+        if url.path == "/health":
+            return {"ok": True, "items": len(main.kb_index.items), "version": main.kb_index.version}
+        if url.path == "/stats":
+            return {"batcher": self.batcher.stats(), "responses": {str(k): v for k, v in self.requests.items()}}
+        if url.path != "/search":
+            raise ApiError(404, f"unknown path: {url.path}")
+
+        if method == "GET":
+            question = parse_qs(url.query).get("q", [""])[0]
+        elif method == "POST":
+            question = self._parse_body(headers, body)
+        else:
+            raise ApiError(405, "use GET or POST")
+        question = question.strip()
+        if not question:
+            raise ApiError(400, "query is empty")
+        if len(question) > MAX_QUERY_CHARS:
+            raise ApiError(400, f"query is longer than {MAX_QUERY_CHARS} characters")
+
+        answer, score, candidates, kb_index = await self.batcher.search(question)
+        return format_result(question, answer, score, candidates, kb_index)
+
+    @staticmethod
+    def _parse_body(headers: Dict[str, str], body: bytes) -> str:
+        try:
+            if headers.get("content-type", "").startswith("application/json"):
+                question = json.loads(body.decode("utf-8")).get("query", "")
+            else:
+                question = parse_qs(body.decode("utf-8")).get("q", [""])[0]
+        except (UnicodeDecodeError, json.JSONDecodeError, AttributeError):
+            raise ApiError(400, "expected JSON object with a \"query\" field")
+        if not isinstance(question, str):
+            raise ApiError(400, "\"query\" must be a string")
+        return question
+
+# ============================================================
+# 🚀 ЗАПУСК
+# ============================================================
+
+async def serve(args: argparse.Namespace) -> None:
+    # Оценки пользователей влияют на порядок так же, как в боте; файл счётчиков пишет только бот
+    feedback = None
+    if os.path.exists(main.FEEDBACK_STATS_FILE):
+        feedback = main.feedback_stats
+        feedback.load(main.kb_index)
+
+    batcher = MicroBatcher(args.batch_size, args.batch_wait / 1000, args.queue_size, feedback)
+    batcher.start()
+    api = SearchAPI(batcher)
+    server = await asyncio.start_server(api.handle, args.host, args.port)
+    print(f"🔌 Поиск доступен на http://{args.host}:{args.port}/search ({len(main.kb_index.items)} записей)")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await batcher.stop()
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description="Локальный HTTP API поиска по базе знаний Прогресс Бота")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="адрес (по умолчанию только локальный)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--kb", default=main.KB_FILE, help="файл базы знаний")
+    parser.add_argument("--attach", action="store_true", help="подключиться к индексу, опубликованному ботом")
+    parser.add_argument("--index-dir", default=main.SHARED_INDEX_DIR, help="каталог общего индекса")
+    parser.add_argument("--batch-size", type=int, default=BATCH_MAX_SIZE, help="максимум вопросов в пакете")
+    parser.add_argument("--batch-wait", type=float, default=BATCH_MAX_WAIT_MS, help="сколько добирать пакет, мс")
+    parser.add_argument("--queue-size", type=int, default=BATCH_QUEUE_SIZE, help="очередь вопросов до отказа 503")
+    args = parser.parse_args()
+
+    if args.attach:
+        main.kb_index = main.attach_kb_index(args.index_dir)
+    else:
+        main.kb_index = main.preprocess_knowledge_base(main.iter_knowledge_base(args.kb))
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main_cli()
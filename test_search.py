@@ -0,0 +1,174 @@
+"""
+Проверки поиска: пакетный поиск против одиночного, кандидаты каскада против полного прохода,
+правка индекса против полной пересборки, потоковое чтение базы против json.load.
+Запуск: python -m unittest test_search (или pytest test_search.py).
+"""
+
+import io
+import json
+import math
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+import main
+
+KB_PATH = str(Path(__file__).with_name("main.json"))
+
+
+def search_queries(kb_index: main.KBIndex) -> list:
+    """Ключевые фразы записей, их пары и начала ответов — и точные, и неточные вопросы."""
+    queries = []
+    for item in kb_index.items:
+        if not item.context:
+            continue
+        queries.extend(item.original_keywords[:2])
+        queries.append(" ".join(item.original_keywords[:2]))
+        queries.append(" ".join(main.preprocess_text(item.context).split()[:6]))
+    queries += ["а рассрочка", "сколько стоит обучение?", "кто такой алексей", "привет", "ыыы", ""]
+    return queries
+
+
+def results_key(result) -> tuple:
+    answer, score, candidates = result
+    return answer, round(score, 6), [c["index"] for c in candidates]
+
+
+class BatchSearchTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.kb_index = main.preprocess_knowledge_base(main.iter_knowledge_base(KB_PATH))
+        cls.queries = search_queries(cls.kb_index)
+
+    def test_batch_matches_single(self):
+        single = [results_key(main.search_knowledge_base(q, self.kb_index, deadline=math.inf)) for q in self.queries]
+        for batch_size in (1, 7, 64):
+            batch = []
+            for start in range(0, len(self.queries), batch_size):
+                batch += main.search_knowledge_base_batch(self.queries[start:start + batch_size], self.kb_index)
+            with self.subTest(batch_size=batch_size):
+                self.assertEqual(single, [results_key(result) for result in batch])
+
+
+class CascadeCandidatesTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        kb_index = main.preprocess_knowledge_base(main.iter_knowledge_base(KB_PATH))
+        # Удалённая запись и запись со старым TF-IDF — как в индексе между правкой и переобучением
+        kb_index, _ = main.update_kb_entry(kb_index, 3, [], "")
+        kb_index, _ = main.update_kb_entry(kb_index, None, ["пентест"], "Да, есть курс по пентесту.")
+        cls.kb_index = kb_index
+        cls.queries = search_queries(kb_index) + ["пентест"]
+
+    def test_candidates_match_full_scan(self):
+        analyses = [main.analyze_query(main.preprocess_question(q), self.kb_index) for q in self.queries]
+        # Составные запросы из нескольких реплик — как уточнения в диалоге
+        analyses += [main.combine_turns(a, [b]) for a, b in zip(analyses[1::7], analyses[::7])]
+        for analysis in analyses:
+            candidates = self.kb_index.cascade_candidates(analysis)
+            with self.subTest(query=analysis.text):
+                self.assertEqual(
+                    self.kb_index.keyword_search(analysis, top_k=5),
+                    self.kb_index.keyword_search(analysis, top_k=5, candidates=candidates)
+                )
+                self.assertEqual(
+                    self.kb_index.fulltext_search(analysis, top_k=5),
+                    self.kb_index.fulltext_search(analysis, top_k=5, candidates=candidates)
+                )
+                self.assertLess(len(candidates), len(self.kb_index.items))
+
+    def test_edited_postings_match_transpose(self):
+        kb_index = self.kb_index
+        for postings, matrix in ((kb_index.keyword_postings, kb_index.keyword_matrix),
+                                 (kb_index.labeled_postings, kb_index.tfidf_labeled_matrix),
+                                 (kb_index.raw_postings, kb_index.tfidf_raw_matrix)):
+            expected = matrix.T.tocsr()
+            expected.sort_indices()
+            self.assertEqual(expected.shape, postings.shape)
+            np.testing.assert_array_equal(expected.indptr, postings.indptr)
+            np.testing.assert_array_equal(expected.indices, postings.indices)
+            np.testing.assert_array_equal(expected.data, postings.data)
+
+
+class UpdateKBEntryTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.kb_index = main.preprocess_knowledge_base(main.iter_knowledge_base(KB_PATH))
+
+    @staticmethod
+    def rebuild(kb_index: main.KBIndex) -> main.KBIndex:
+        """Полная пересборка из живых записей — как после перезапуска бота с сохранённой базой."""
+        return main.preprocess_knowledge_base(
+            {"id": item.item_id, "context": item.context, "keywords": list(item.original_keywords)}
+            for item in kb_index.items if item.context
+        )
+
+    def edit(self) -> main.KBIndex:
+        kb_index, _ = main.update_kb_entry(self.kb_index, 5, ["не за что", "спасибо большое"], "Всегда рад помочь!")
+        kb_index, _ = main.update_kb_entry(
+            kb_index, None, ["курс по кибербезопасности", "пентест"],
+            "<b>Кибербезопасность</b>\nДа, есть курс по кибербезопасности и пентесту."
+        )
+        return kb_index
+
+    def test_edit_and_refit_match_rebuild(self):
+        edited = main.refit_kb_index(self.edit())
+        rebuilt = self.rebuild(edited)
+        self.assertEqual(rebuilt.exact_phrases, edited.exact_phrases)
+        self.assertEqual(sorted(rebuilt.all_keywords_list), sorted(edited.all_keywords_list))
+        queries = search_queries(rebuilt) + ["есть ли курсы по кибербезопасности", "пентест"]
+        for query in queries:
+            with self.subTest(query=query):
+                self.assertEqual(
+                    results_key(main.search_knowledge_base(query, rebuilt, deadline=math.inf)),
+                    results_key(main.search_knowledge_base(query, edited, deadline=math.inf))
+                )
+
+    def test_keyword_scores_match_rebuild_without_refit(self):
+        # Ключевые слова не зависят от TF-IDF: совпадают с пересборкой сразу, без переобучения
+        edited = self.edit()
+        added = len(edited.items) - 1
+        edited, _ = main.update_kb_entry(edited, 3, [], "")
+        rebuilt = self.rebuild(edited)
+        live = np.array([i for i, item in enumerate(edited.items) if item.context])
+        for query in search_queries(rebuilt) + ["пентест"]:
+            edited_scores = edited.keyword_scores(main.analyze_query(query, edited))
+            rebuilt_scores = rebuilt.keyword_scores(main.analyze_query(query, rebuilt))
+            with self.subTest(query=query):
+                np.testing.assert_allclose(edited_scores[live], rebuilt_scores, rtol=1e-6)
+                self.assertEqual(edited_scores[3], 0)
+        self.assertEqual(main.search_knowledge_base("пентест", edited)[2][0]["index"], added)
+        self.assertFalse(edited.is_valid_index(3))
+
+
+class IterJsonArrayTest(unittest.TestCase):
+    CHUNK_SIZES = (1, 2, 3, 7, 64)
+
+    def read(self, text: str, chunk_chars: int) -> list:
+        return list(main._iter_json_array(io.StringIO(text), chunk_chars))
+
+    def test_knowledge_base_file(self):
+        with open(KB_PATH, encoding="utf-8") as f:
+            text = f.read()
+        expected = json.loads(text)
+        for chunk_chars in self.CHUNK_SIZES + (main.KB_READ_CHUNK_CHARS,):
+            with self.subTest(chunk_chars=chunk_chars):
+                self.assertEqual(expected, self.read(text, chunk_chars))
+
+    def test_valid_arrays(self):
+        for text in ("[]", " [ ]\n", "[12345, 678]", '[{"a": [1, 2]} , {"b": "x,]"}]', "[1]  \n"):
+            for chunk_chars in self.CHUNK_SIZES:
+                with self.subTest(text=text, chunk_chars=chunk_chars):
+                    self.assertEqual(json.loads(text), self.read(text, chunk_chars))
+
+    def test_malformed_arrays(self):
+        for text in ("[1,,2]", "[1 2]", "[1,]", "[,1]", "[1,2", "[1]x", "{}", ""):
+            for chunk_chars in self.CHUNK_SIZES:
+                with self.subTest(text=text, chunk_chars=chunk_chars):
+                    with self.assertRaises(ValueError):
+                        self.read(text, chunk_chars)
+
+
+if __name__ == "__main__":
+    unittest.main()